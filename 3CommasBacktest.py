@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    *******************************************************************************************
+    3CommasBacktest: Offline backtester for the 3CommasBot LONG & SHORT martingale ladder
+    Author: Ali Toori
+    Website: https://boteaz.com/
+    *******************************************************************************************
+"""
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from time import time
+import numpy as np
+
+PROJECT_ROOT = Path(os.path.abspath(os.path.dirname(__file__)))
+FILE_SETTINGS = str(PROJECT_ROOT / '3CommasRes/Settings.json')
+FILE_PAIRS = str(PROJECT_ROOT / '3CommasRes/Pairs.csv')
+DIR_HISTORY = str(PROJECT_ROOT / '3CommasRes/History')
+FILE_SWEEP = str(PROJECT_ROOT / '3CommasRes/Sweep.json')
+FILE_RULES = str(PROJECT_ROOT / '3CommasRes/MarketRules.json')
+STRATEGY_KEYS = ('AmountUSDT', 'Leverage', 'TakeProfit1', 'TakeProfit2', 'TrailingStopLoss', 'LevelCap')
+# Candle arrays attached by every sweep worker process
+WORKER_ARRAYS = {}
+
+
+def get_strategy_params(settings):
+    """
+    :param settings: "Settings" of Settings.json
+    :return: strategy knobs used by the backtest, LevelCap defaults to the bot's reset level 7
+    """
+    params = {key: settings[key] for key in STRATEGY_KEYS if key in settings}
+    params.setdefault('LevelCap', 7)
+    return params
+
+
+# Load high/low/close candles of a pair
+def load_candles(file_candles):
+    """
+    Reads an OHLCV CSV, either with a header naming high/low/close or in Binance kline order
+    (open_time, open, high, low, close, volume, ...). A .npy copy is cached next to the CSV.
+    :param file_candles: path to the CSV file
+    :return: (n, 3) array of high, low, close
+    """
+    file_cache = f'{file_candles}.npy'
+    if os.path.isfile(file_cache) and os.path.getmtime(file_cache) >= os.path.getmtime(file_candles):
+        return np.load(file_cache)
+    with open(file_candles, 'r') as f:
+        header = f.readline().strip().lower().split(',')
+    if header[0].replace('.', '', 1).isdigit():
+        columns, skip_rows = (2, 3, 4), 0
+    else:
+        columns, skip_rows = tuple(header.index(column) for column in ('high', 'low', 'close')), 1
+    candles = np.loadtxt(file_candles, delimiter=',', skiprows=skip_rows, usecols=columns, dtype=np.float64, ndmin=2)
+    np.save(file_cache, candles)
+    return candles
+
+
+# Load candles of many pairs into padded (pairs, bars) arrays
+def load_history(pairs, data_dir=DIR_HISTORY):
+    """
+    :param pairs: pairs to load, read from <data_dir>/<pair>.csv
+    :param data_dir: directory of the OHLCV files
+    :return: highs, lows, closes arrays of shape (pairs, bars) and the number of bars of every pair
+    """
+    candles = [load_candles(os.path.join(data_dir, f'{pair}.csv')) for pair in pairs]
+    lengths = np.array([len(pair_candles) for pair_candles in candles], dtype=np.int64)
+    highs, lows, closes = (np.full((len(pairs), max(lengths, default=0)), np.nan) for _ in range(3))
+    for i, pair_candles in enumerate(candles):
+        highs[i, :lengths[i]], lows[i, :lengths[i]], closes[i, :lengths[i]] = pair_candles.T
+    return highs, lows, closes, lengths
+
+
+# Lot step, minimum lot and minimum notional of every pair, 0 where a pair has no rules
+def load_rules(pairs, file_rules=FILE_RULES):
+    """
+    :param file_rules: JSON of pair: rules, with the lot_step, min_lot and min_total of ThreeCommasBot.get_market_rules()
+    :return: dict of lot_steps, min_lots and min_totals arrays of shape (pairs,)
+    """
+    rules = {}
+    if file_rules and os.path.isfile(file_rules):
+        with open(file_rules, 'r') as f:
+            rules = json.load(f)
+    return {f'{key}s': np.array([float((rules.get(pair) or {}).get(key) or 0) for pair in pairs])
+            for key in ('lot_step', 'min_lot', 'min_total')}
+
+
+# Quantities of a level, rounded like ThreeCommasBot.get_level_ladder() does
+def get_quantities(amount, price, lot_steps, min_lots, min_totals):
+    """
+    Down to the lot step and raised to the minimum lot or notional, to 3 decimals for pairs without a lot step
+    :param amount: (pairs,) USDT amounts
+    :param price: (pairs,) entry prices
+    :return: (pairs,) quantities
+    """
+    step = np.where(lot_steps > 0, lot_steps, 1.0)
+    # The bot rounds with decimals, the epsilon keeps exact multiples of the step from falling a step short
+    qty = np.floor(amount / price / step + 1e-9) * step
+    min_qty = np.maximum(min_lots, min_totals / price)
+    qty = np.where(qty < min_qty, np.ceil(min_qty / step - 1e-9) * step, qty)
+    return np.where(lot_steps > 0, qty, np.round(amount / price, 3))
+
+
+# Index of the first True of every row, the row width if there is none
+def first_true(mask):
+    return np.where(mask.any(axis=1), mask.argmax(axis=1), mask.shape[1])
+
+
+# Simulate one SmartTrade leg of every pair over a window of bars
+def simulate_leg(high, low, entry, params):
+    """
+    Prices are those of a LONG leg, a SHORT leg is simulated by passing -low, -high and -entry. Both TP steps close
+    50%, the stop loss starts TrailingStopLoss% away from entry and trails the best price. When the stop and a TP are
+    both touched within one bar, the stop is assumed to fill first.
+    :param high: (pairs, window) highs after the entry bar
+    :param low: (pairs, window) lows after the entry bar
+    :param entry: (pairs,) entry prices
+    :param params: strategy knobs
+    :return: exit bar (window width if still open), PnL per unit and whether both TP steps filled
+    """
+    size = np.abs(entry)
+    tsl = params['TrailingStopLoss'] / 100
+    tp1 = entry + params['TakeProfit1'] / 100 * size
+    tp2 = entry + params['TakeProfit2'] / 100 * size
+    best = np.maximum.accumulate(np.maximum(high, entry[:, None]), axis=1)
+    stop = np.concatenate([(entry - tsl * size)[:, None], (best - tsl * np.abs(best))[:, :-1]], axis=1)
+    bar_sl = first_true(low <= stop)
+    bar_tp1 = first_true(high >= tp1[:, None])
+    bar_tp2 = first_true(high >= tp2[:, None])
+    stop_price = np.take_along_axis(stop, np.minimum(bar_sl, stop.shape[1] - 1)[:, None], axis=1)[:, 0]
+    tp_hit = bar_tp2 < bar_sl
+    pnl = np.where(tp_hit, 0.5 * (tp1 - entry) + 0.5 * (tp2 - entry),
+                   np.where(bar_tp1 < bar_sl, 0.5 * (tp1 - entry) + 0.5 * (stop_price - entry), stop_price - entry))
+    return np.minimum(bar_sl, bar_tp2), pnl, tp_hit
+
+
+# Replay the LONG & SHORT ladder of every pair through its candles
+def run_backtest(highs, lows, closes, lengths, params, rules=None, window=256):
+    """
+    Every round places a LONG and a SHORT leg at the close of the entry bar and ends once both legs closed. If any
+    leg took its TPs the next round starts from the base order, otherwise the amount doubles up to LevelCap, where
+    the ladder starts over, as in ThreeCommasBot.strategy(). All the pairs advance one round per iteration.
+    :param highs: (pairs, bars) highs
+    :param lows: (pairs, bars) lows
+    :param closes: (pairs, bars) closes
+    :param lengths: (pairs,) number of bars of every pair
+    :param params: strategy knobs, see get_strategy_params()
+    :param rules: market rules arrays of load_rules(), None to round quantities to 3 decimals
+    :param window: bars simulated per round before looking further ahead
+    :return: dict of per-pair result arrays
+    """
+    n_pairs, n_bars = closes.shape
+    if rules is None:
+        rules = {key: np.zeros(n_pairs) for key in ('lot_steps', 'min_lots', 'min_totals')}
+    entry_bar = np.zeros(n_pairs, dtype=np.int64)
+    level = np.ones(n_pairs, dtype=np.int64)
+    results = {key: np.zeros(n_pairs, dtype=np.int64) for key in ('Rounds', 'TP', 'TSL', 'MaxLevel')}
+    results.update({key: np.zeros(n_pairs) for key in ('PnL', 'Peak', 'MaxDrawdown')})
+    active = lengths > 1
+    while active.any():
+        pending = np.flatnonzero(active)
+        pending_window = window
+        while pending.size:
+            bars = entry_bar[pending, None] + 1 + np.arange(pending_window)
+            valid = bars < lengths[pending, None]
+            bars = np.minimum(bars, n_bars - 1)
+            high = np.where(valid, highs[pending[:, None], bars], np.nan)
+            low = np.where(valid, lows[pending[:, None], bars], np.nan)
+            entry = closes[pending, entry_bar[pending]]
+            exit_l, pnl_l, tp_l = simulate_leg(np.nan_to_num(high, nan=-np.inf), np.nan_to_num(low, nan=np.inf),
+                                               entry, params)
+            exit_s, pnl_s, tp_s = simulate_leg(np.nan_to_num(-low, nan=-np.inf), np.nan_to_num(-high, nan=np.inf),
+                                               -entry, params)
+            exit_bar = np.maximum(exit_l, exit_s)
+            closed = exit_bar < pending_window
+            out_of_data = ~closed & ~valid[:, -1]
+            active[pending[out_of_data]] = False
+            done = pending[closed]
+            if done.size:
+                amount = np.round(params['AmountUSDT'] * 2.0 ** (level[done] - 1), 2)
+                qty = get_quantities(amount, entry[closed], *(rules[key][done] for key in ('lot_steps', 'min_lots', 'min_totals')))
+                round_pnl = qty * (pnl_l[closed] + pnl_s[closed])
+                tp = tp_l[closed] | tp_s[closed]
+                results['Rounds'][done] += 1
+                results['TP'][done] += tp
+                results['TSL'][done] += ~tp
+                results['MaxLevel'][done] = np.maximum(results['MaxLevel'][done], level[done])
+                results['PnL'][done] += round_pnl
+                results['Peak'][done] = np.maximum(results['Peak'][done], results['PnL'][done])
+                results['MaxDrawdown'][done] = np.maximum(results['MaxDrawdown'][done],
+                                                          results['Peak'][done] - results['PnL'][done])
+                level[done] = np.where(tp | (level[done] >= params['LevelCap']), 1, level[done] + 1)
+                entry_bar[done] += 1 + exit_bar[closed]
+                active[done] = entry_bar[done] < lengths[done] - 1
+            pending = pending[~closed & ~out_of_data]
+            pending_window *= 4
+    # Capital committed by both legs at the deepest level reached
+    results['MaxNotional'] = 2 * params['AmountUSDT'] * 2.0 ** (np.maximum(results['MaxLevel'], 1) - 1)
+    results['MaxMargin'] = results['MaxNotional'] / params.get('Leverage', 1)
+    del results['Peak']
+    return results
+
+
+def print_results(pairs, results):
+    print(f'{"Pair":<16}{"Rounds":>8}{"TP":>7}{"TSL":>7}{"MaxLevel":>10}{"PnL":>12}{"MaxDD":>12}{"MaxMargin":>12}')
+    for i, pair in enumerate(pairs):
+        print(f'{pair:<16}{results["Rounds"][i]:>8}{results["TP"][i]:>7}{results["TSL"][i]:>7}'
+              f'{results["MaxLevel"][i]:>10}{results["PnL"][i]:>12.2f}{results["MaxDrawdown"][i]:>12.2f}'
+              f'{results["MaxMargin"][i]:>12.2f}')
+
+
+# Every combination of the sweep values, on top of the base knobs
+def get_sweep_params(base_params, sweep):
+    """
+    :param base_params: strategy knobs of Settings.json
+    :param sweep: dict of knob: list of values to try
+    :return: list of strategy knobs, combinations with TakeProfit2 below TakeProfit1 are skipped
+    """
+    keys = list(sweep)
+    sweep_params = []
+    for values in itertools.product(*[sweep[key] for key in keys]):
+        params = dict(base_params, **dict(zip(keys, values)))
+        if params['TakeProfit2'] >= params['TakeProfit1']:
+            sweep_params.append(params)
+    return sweep_params
+
+
+# Copy an array to shared memory
+def share_array(array):
+    """
+    :return: SharedMemory block and (name, shape, dtype) to attach it in another process
+    """
+    shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+# Attach the shared candle arrays in a sweep worker, without copying them
+def init_worker(array_specs):
+    for key, (name, shape, dtype) in array_specs.items():
+        shm = SharedMemory(name=name)
+        WORKER_ARRAYS[key] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+
+# Backtest one combination in a sweep worker
+def evaluate(params):
+    """
+    :param params: strategy knobs
+    :return: totals of all the pairs, drawdown and margin are summed as if every pair hit its worst at once
+    """
+    arrays = {key: array for key, (_, array) in WORKER_ARRAYS.items()}
+    rules = {key: arrays[key] for key in ('lot_steps', 'min_lots', 'min_totals')}
+    results = run_backtest(arrays['highs'], arrays['lows'], arrays['closes'], arrays['lengths'], params, rules=rules)
+    return {"Params": params, "PnL": float(results['PnL'].sum()), "MaxDrawdown": float(results['MaxDrawdown'].sum()),
+            "MaxMargin": float(results['MaxMargin'].sum()), "MaxLevel": int(results['MaxLevel'].max(initial=0)),
+            "TP": int(results['TP'].sum()), "TSL": int(results['TSL'].sum())}
+
+
+# Backtest every combination across a process pool sharing one copy of the candles
+def run_sweep(highs, lows, closes, lengths, sweep_params, rules, workers=None):
+    """
+    :param rules: market rules arrays of load_rules()
+    :return: results of evaluate(), ranked by PnL
+    """
+    workers = workers or os.cpu_count() or 1
+    shared = {key: share_array(array) for key, array in
+              (('highs', highs), ('lows', lows), ('closes', closes), ('lengths', lengths), *rules.items())}
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                    initargs=({key: spec for key, (_, spec) in shared.items()},)) as executor:
+            chunk_size = max(1, len(sweep_params) // (workers * 4))
+            results = list(executor.map(evaluate, sweep_params, chunksize=chunk_size))
+    finally:
+        for shm, _ in shared.values():
+            shm.close()
+            shm.unlink()
+    return sorted(results, key=lambda result: result['PnL'], reverse=True)
+
+
+def print_sweep(results, sweep, top=20):
+    keys = list(sweep)
+    print(f'{"Rank":<6}' + ''.join(f'{key:>18}' for key in keys) +
+          f'{"PnL":>12}{"MaxDD":>12}{"MaxMargin":>12}{"MaxLevel":>10}{"TP":>7}{"TSL":>7}')
+    for rank, result in enumerate(results[:top], start=1):
+        print(f'{rank:<6}' + ''.join(f'{result["Params"][key]:>18}' for key in keys) +
+              f'{result["PnL"]:>12.2f}{result["MaxDrawdown"]:>12.2f}{result["MaxMargin"]:>12.2f}'
+              f'{result["MaxLevel"]:>10}{result["TP"]:>7}{result["TSL"]:>7}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backtest the 3CommasBot ladder on local OHLCV candles')
+    parser.add_argument('--pairs', nargs='+', help='pairs to backtest, defaults to Pairs.csv')
+    parser.add_argument('--data-dir', default=DIR_HISTORY, help='directory of <pair>.csv OHLCV files')
+    parser.add_argument('--rules', default=FILE_RULES, help='market rules JSON of pair: lot_step, min_lot and min_total, '
+                                                            'defaults to MarketRules.json')
+    parser.add_argument('--json', help='also save results to this JSON file')
+    parser.add_argument('--sweep', nargs='?', const=FILE_SWEEP,
+                        help='sweep the knobs listed in this JSON file, defaults to Sweep.json')
+    parser.add_argument('--workers', type=int, help='sweep worker processes, defaults to the number of cores')
+    parser.add_argument('--top', type=int, default=20, help='sweep results to print')
+    args = parser.parse_args()
+    with open(FILE_SETTINGS, 'r') as f:
+        params = get_strategy_params(json.load(f)["Settings"])
+    pairs = args.pairs
+    if not pairs:
+        with open(FILE_PAIRS, 'r') as f:
+            pairs = [line.strip() for line in f.readlines()[1:] if line.strip()]
+    highs, lows, closes, lengths = load_history(pairs, data_dir=args.data_dir)
+    rules = load_rules(pairs, file_rules=args.rules)
+    start = time()
+    if args.sweep:
+        with open(args.sweep, 'r') as f:
+            sweep = json.load(f)
+        results = run_sweep(highs, lows, closes, lengths, get_sweep_params(params, sweep), rules=rules,
+                            workers=args.workers)
+        print(f'Swept {len(results)} combinations over {len(pairs)} pairs in {time() - start:.2f}s')
+        print_sweep(results, sweep, top=args.top)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=4)
+        return
+    results = run_backtest(highs, lows, closes, lengths, params, rules=rules)
+    print(f'Backtested {len(pairs)} pairs, {int(lengths.sum())} candles in {time() - start:.2f}s with {params}')
+    print_results(pairs, results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"Params": params, "Pairs": {pair: {key: value[i].item() for key, value in results.items()}
+                                                   for i, pair in enumerate(pairs)}}, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
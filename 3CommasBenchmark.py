@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    *******************************************************************************************
+    3CommasBenchmark: Benchmark suite of 3CommasBot against the local 3Commas stand-in
+    Author: Ali Toori
+    Website: https://boteaz.com/
+    *******************************************************************************************
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from time import monotonic
+
+PROJECT_ROOT = Path(os.path.abspath(os.path.dirname(__file__)))
+DIR_BENCHMARKS = str(PROJECT_ROOT / '3CommasRes/Benchmarks')
+bot_module = importlib.import_module('3CommasBot')
+sim_module = importlib.import_module('3CommasSimServer')
+
+# Fast strategy settings so that re-entries happen within a short run
+BENCH_SETTINGS = {
+    "APIName": "Benchmark", "APIKey": "bench", "APISecret": "bench",
+    "AccountIDLong": 1, "AccountIDShort": 2, "OrderType": "market", "Leverage": 15.0, "AmountUSDT": 10,
+    "TakeProfit1": 0.5, "TakeProfit2": 0.8, "TrailingStopLoss": 0.4, "LevelCap": 7,
+    "CheckInterval": 1, "MinCheckInterval": 0.2, "MaxCheckInterval": 2, "NearTargetPercent": 0.2,
+    "MaxWorkers": 32, "RequestRate": 1000, "RequestBurst": 1000, "BotToken": "", "ChatID": "",
+}
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+# Run the bot on pair_count simulated pairs for duration seconds
+def run_case(pair_count, duration, latency, tick, trace_memory=False, stream=False):
+    """
+    :return: dict of the measurements of the run
+    """
+    pairs = [f'USDT_BENCH{i}' for i in range(pair_count)]
+    exchange = sim_module.SimExchange(pairs=pairs, account_ids=[BENCH_SETTINGS['AccountIDLong'],
+                                                                BENCH_SETTINGS['AccountIDShort']],
+                                      volatility=0.002, latency=latency, seed=pair_count)
+    exchange.start(tick_interval=tick)
+    with tempfile.TemporaryDirectory() as res_dir:
+        if trace_memory:
+            tracemalloc.start()
+        bot = bot_module.ThreeCommasBot(settings=dict(BENCH_SETTINGS), res_dir=res_dir)
+        bot.client = bot.get_client(client=sim_module.SimClient(exchange))
+        bot.stream.connect = sim_module.SimStream(exchange).connect if stream else None
+        logging.getLogger().setLevel(logging.WARNING)
+
+        async def run():
+            try:
+                await asyncio.wait_for(bot.run_pairs(pairs_list=pairs), timeout=duration)
+            except asyncio.TimeoutError:
+                pass
+
+        start = monotonic()
+        asyncio.run(run())
+        elapsed = monotonic() - start
+        exchange.stop()
+        memory = None
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(True, '*3CommasBot.py')])
+            memory = sum(stat.size for stat in snapshot.statistics('filename'))
+            tracemalloc.stop()
+    ticks = sum(state.ticks for state in bot.pair_states.values())
+    latencies = list(bot.reentry_latencies)
+    return {
+        "Pairs": pair_count,
+        "Stream": stream,
+        "Seconds": round(elapsed, 3),
+        "PairTicksPerSecond": round(ticks / elapsed, 2),
+        "PairTicks": ticks,
+        "APICalls": exchange.requests,
+        "APICallsPerPairPerMinute": round(exchange.requests / pair_count / (elapsed / 60), 3),
+        "Reentries": len(latencies),
+        "ReentryP50Ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "ReentryP99Ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        "MemoryPerPairBytes": round(memory / pair_count) if memory is not None else None,
+    }
+
+
+# Print relative change of every measurement against an earlier results file
+def compare(results, file_baseline):
+    with open(file_baseline, 'r') as f:
+        baseline = {case["Pairs"]: case for case in json.load(f)["Cases"]}
+    for case in results["Cases"]:
+        base_case = baseline.get(case["Pairs"])
+        if base_case is None:
+            continue
+        changes = []
+        for key, value in case.items():
+            base_value = base_case.get(key)
+            if key in ('Pairs', 'Stream', 'Seconds') or not value or not base_value:
+                continue
+            changes.append(f'{key}: {base_value} -> {value} ({(value - base_value) / base_value * 100:+.1f}%)')
+        print(f'Pairs {case["Pairs"]}: ' + ', '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark 3CommasBot against the local 3Commas stand-in')
+    parser.add_argument('--pairs', type=int, nargs='+', default=[10, 100, 500], help='pair counts to run')
+    parser.add_argument('--duration', type=float, default=30, help='seconds per pair count')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean API latency of the stand-in')
+    parser.add_argument('--tick', type=float, default=0.1, help='seconds between price steps of the stand-in')
+    parser.add_argument('--stream', action='store_true', help='push SmartTrade updates over the stand-in websocket')
+    parser.add_argument('--memory', action='store_true', help='trace memory per pair, slows the run down')
+    parser.add_argument('--output', help='results file, defaults to 3CommasRes/Benchmarks/<timestamp>.json')
+    parser.add_argument('--compare', help='earlier results file to compare with')
+    args = parser.parse_args()
+    results = {"TimeStamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "Python": platform.python_version(),
+               "Machine": platform.machine(), "Duration": args.duration, "Latency": args.latency, "Tick": args.tick,
+               "Cases": []}
+    for pair_count in args.pairs:
+        case = run_case(pair_count=pair_count, duration=args.duration, latency=args.latency, tick=args.tick,
+                        trace_memory=args.memory, stream=args.stream)
+        print(json.dumps(case))
+        results["Cases"].append(case)
+    file_output = args.output or os.path.join(DIR_BENCHMARKS, f'{datetime.now().strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(file_output)), exist_ok=True)
+    with open(file_output, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f'Results saved to {file_output}')
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,30 +7,1771 @@
     Website: https://boteaz.com/
     *******************************************************************************************
 """
+import argparse
+import asyncio
+import atexit
+import bisect
+import collections
 import concurrent.futures
+import csv
+import decimal
+import functools
+import gzip
+import hashlib
+import heapq
+import hmac
+import http.server
+import itertools
 import json
 import logging.config
+import logging.handlers
+import math
 import subprocess
 import os
+import queue
+import signal
+import sqlite3
+import struct
+import sys
+import threading
 import requests
 from pathlib import Path
-from time import sleep
-from datetime import datetime
-import pandas as pd
+from time import sleep, monotonic, time
+from datetime import datetime, timedelta
 import pyfiglet
 from py3cw.request import Py3CW
+try:
+    import websockets
+except ImportError:
+    websockets = None
 
 
-class ThreeCommasBot:
+LOG_LISTENER = None
+
+
+# Write the log records still queued when the process exits
+@atexit.register
+def stop_log_listener():
+    if LOG_LISTENER is not None:
+        LOG_LISTENER.stop()
+
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    One JSON object per line, with the pair and level fields of the record. Payloads attached to a record are only
+    serialized here, on the logging thread.
+    """
+    FIELDS = {"pair": "Pair", "level": "Level", "suppressed": "Suppressed"}
+
+    def format(self, record):
+        entry = {"TimeStamp": self.formatTime(record), "LogLevel": record.levelname, "Line": record.lineno,
+                 "Message": record.getMessage()}
+        for attribute, key in self.FIELDS.items():
+            if getattr(record, attribute, None) is not None:
+                entry[key] = getattr(record, attribute)
+        payload = getattr(record, 'payload', None)
+        if payload is not None:
+            entry["Payload"] = payload() if callable(payload) else payload
+        return json.dumps(entry, default=str)
+
+
+class LogSampler(logging.Filter):
+    """
+    Drops repeated status lines of a pair before they are formatted: a record with a sample_key is let through when the
+    key of its pair changes, otherwise at most once every sample_seconds, with the number of lines dropped since
+    """
+    def __init__(self, sample_seconds=60):
+        super().__init__()
+        self.sample_seconds = sample_seconds
+        self.last = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        sample_key = getattr(record, 'sample_key', None)
+        if sample_key is None:
+            return True
+        pair = getattr(record, 'pair', None)
+        now = monotonic()
+        with self.lock:
+            last_key, last_time, suppressed = self.last.get(pair, (None, 0.0, 0))
+            if sample_key == last_key and now - last_time < self.sample_seconds:
+                self.last[pair] = (last_key, last_time, suppressed + 1)
+                return False
+            self.last[pair] = (sample_key, now, 0)
+        record.suppressed = suppressed or None
+        return True
+
+
+class PairState:
+    """
+    Level/TP/TSL state of a single pair, kept outside of strategy() so that each pair runs as its own task
+    """
+    def __init__(self, pair, amount_usdt, level_cap=7):
+        self.pair = pair
+        self.level = 1
+        self.tp_count = 0
+        self.tsl_count = 0
+        self.trade_count = 2
+        self.pnl = 0
+        self.pnls = [0] * (level_cap + 1)
+        self.amount_usdt = amount_usdt
+        self.start_time = datetime.now().strftime("%H:%M:%S")
+        self.smart_trade_id_l = None
+        self.smart_trade_id_s = None
+        self.failed_ids = ()
+        self.ticks = 0
+
+    # Start over from the base order
+    def reset(self, amount_usdt):
+        self.level = 1
+        self.pnls = [0] * len(self.pnls)
+        self.pnl = 0
+        self.amount_usdt = amount_usdt
+
+    def to_dict(self):
+        return {"TimeStamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "StartTime": self.start_time,
+                "Pair": self.pair, "SmartTradeLong": self.smart_trade_id_l, "SmartTradeShort": self.smart_trade_id_s,
+                "PnL": self.pnl, "Level": self.level, "TradeCount": self.trade_count, "TPCount": self.tp_count,
+                "TSLCount": self.tsl_count}
+
+
+class SmartTradePoller:
+    """
+    Fetches the status of all the tracked SmartTrades with one smart_trades_v2 list request per account and
+    hands every snapshot to the pair waiting for it. Trades close to their TP or SL are polled more often than idle ones.
+    While the SmartTrade stream is up, updates are pushed to the waiting pair and polling only reconciles every
+    ReconcileInterval seconds.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.check_interval = bot.settings['CheckInterval']
+        self.min_interval = bot.settings.get('MinCheckInterval', self.check_interval)
+        self.max_interval = bot.settings.get('MaxCheckInterval', self.check_interval)
+        self.near_percent = bot.settings.get('NearTargetPercent', 0.5)
+        self.reconcile_interval = bot.settings.get('ReconcileInterval', 60)
+        self.streaming = False
+        self.accounts = {}
+        self.pairs = {}
+        self.pair_ids = {}
+        self.snapshots = {}
+        self.pushed = set()
+        self.unclaimed = collections.OrderedDict()
+        self.next_poll = {}
+        self.last_polled = {}
+        self.waiters = {}
+        self.wakeup = asyncio.Event()
+
+    @staticmethod
+    def get_targets(smart_trade):
+        """
+        :param smart_trade: SmartTrade data
+        :return: current price and TP/SL prices of the SmartTrade, (None, []) if the data has no prices
+        """
+        try:
+            price = float(smart_trade["data"]["current_price"]["last"])
+        except (KeyError, TypeError, ValueError):
+            return None, []
+        targets = []
+        for step in (smart_trade.get("take_profit") or {}).get("steps") or []:
+            try:
+                targets.append(float(step["price"]["value"]))
+            except (KeyError, TypeError, ValueError):
+                pass
+        try:
+            targets.append(float(smart_trade["stop_loss"]["conditional"]["price"]["value"]))
+        except (KeyError, TypeError, ValueError):
+            pass
+        return price, targets
+
+    # Seconds until a SmartTrade should be polled again
+    def get_interval(self, smart_trade):
+        if self.streaming:
+            return self.reconcile_interval
+        price, targets = self.get_targets(smart_trade)
+        if not price or not targets:
+            return self.check_interval
+        distance = min(abs(price - target) / price * 100 for target in targets)
+        if distance <= self.near_percent:
+            return self.min_interval
+        return min(self.max_interval, self.min_interval * distance / self.near_percent)
+
+    # Wait for the next status snapshot of a SmartTrade
+    async def get(self, smart_trade_id, account_id, pair=None):
+        """
+        :param smart_trade_id: SmartTrade to wait for
+        :param account_id: account the SmartTrade was placed on
+        :param pair: pair of the SmartTrade, pushed updates wake all the SmartTrades of the same pair
+        :return: SmartTrade data, as returned by smart_trades_v2/get_by_id
+        """
+        loop = asyncio.get_running_loop()
+        smart_trade_id = str(smart_trade_id)
+        self.accounts[smart_trade_id] = account_id
+        if pair is not None:
+            self.pairs[smart_trade_id] = pair
+            self.pair_ids.setdefault(pair, set()).add(smart_trade_id)
+        if smart_trade_id in self.unclaimed:
+            self.snapshots[smart_trade_id] = self.unclaimed.pop(smart_trade_id)
+        # An update was pushed while nobody was waiting for it, or the SmartTrade has already finished
+        smart_trade = self.snapshots.get(smart_trade_id)
+        if smart_trade_id in self.pushed or (smart_trade and self.bot.get_smart_trade_outcome(smart_trade) != 'open'):
+            self.pushed.discard(smart_trade_id)
+            return smart_trade
+        waiter = loop.create_future()
+        self.waiters.setdefault(smart_trade_id, []).append(waiter)
+        if smart_trade_id not in self.next_poll:
+            self.next_poll[smart_trade_id] = loop.time() + self.check_interval
+            self.wakeup.set()
+        return await waiter
+
+    # Stop polling a SmartTrade that was replaced by a new level
+    def forget(self, smart_trade_id):
+        smart_trade_id = str(smart_trade_id)
+        self.accounts.pop(smart_trade_id, None)
+        pair = self.pairs.pop(smart_trade_id, None)
+        pair_ids = self.pair_ids.get(pair)
+        if pair_ids is not None:
+            pair_ids.discard(smart_trade_id)
+            if not pair_ids:
+                del self.pair_ids[pair]
+        self.snapshots.pop(smart_trade_id, None)
+        self.pushed.discard(smart_trade_id)
+        self.next_poll.pop(smart_trade_id, None)
+        self.last_polled.pop(smart_trade_id, None)
+        for waiter in self.waiters.pop(smart_trade_id, []):
+            waiter.cancel()
+
+    # Fetch the due SmartTrades and resolve their waiters
+    async def poll(self, due_ids):
+        loop = asyncio.get_running_loop()
+        account_ids = sorted({self.accounts[smart_trade_id] for smart_trade_id in due_ids}, key=str)
+        results = await asyncio.gather(*[self.bot.run_blocking(self.bot.get_smart_trades, account_id=account_id)
+                                         for account_id in account_ids])
+        smart_trades = {}
+        failed_accounts = set()
+        for account_id, result in zip(account_ids, results):
+            if result is None:
+                failed_accounts.add(account_id)
+                continue
+            for smart_trade in result:
+                smart_trades[str(smart_trade["id"])] = smart_trade
+                price, _ = self.get_targets(smart_trade)
+                if price and "pair" in smart_trade:
+                    self.bot.price_cache.put(smart_trade["pair"], price)
+        # Trades missing from the active list have finished, fetch their final status one by one
+        finished_ids = [smart_trade_id for smart_trade_id in due_ids
+                        if smart_trade_id not in smart_trades and self.accounts[smart_trade_id] not in failed_accounts]
+        finished = await asyncio.gather(*[self.bot.run_blocking(self.bot.get_smart_trade_by_id, smart_trade_id=smart_trade_id)
+                                          for smart_trade_id in finished_ids])
+        smart_trades.update({smart_trade_id: data for smart_trade_id, data in zip(finished_ids, finished) if data})
+        now = loop.time()
+        for smart_trade_id in due_ids:
+            if smart_trade_id not in self.next_poll:
+                continue
+            smart_trade = smart_trades.get(smart_trade_id)
+            if smart_trade is None:
+                self.next_poll[smart_trade_id] = now + self.check_interval
+                continue
+            if "pair" in smart_trade and smart_trade_id in self.last_polled:
+                self.bot.metrics.observe_loop_lag(pair=smart_trade["pair"], lag=now - self.next_poll[smart_trade_id],
+                                                  interval=now - self.last_polled[smart_trade_id])
+            self.last_polled[smart_trade_id] = now
+            self.next_poll[smart_trade_id] = now + self.get_interval(smart_trade)
+            self.snapshots[smart_trade_id] = smart_trade
+            for waiter in self.waiters.pop(smart_trade_id, []):
+                if not waiter.done():
+                    waiter.set_result(smart_trade)
+
+    # Hand the latest snapshot of a SmartTrade to its waiters, or keep it for the next get() if there are none
+    def resolve(self, smart_trade_id):
+        waiters = [waiter for waiter in self.waiters.pop(smart_trade_id, []) if not waiter.done()]
+        if not waiters:
+            self.pushed.add(smart_trade_id)
+            return
+        self.pushed.discard(smart_trade_id)
+        for waiter in waiters:
+            waiter.set_result(self.snapshots[smart_trade_id])
+
+    # Wake the pair of a SmartTrade update pushed by the stream
+    def push(self, smart_trade):
+        """
+        :param smart_trade: SmartTrade data, as sent by SmartTradesChannel
+        """
+        smart_trade_id = str(smart_trade.get("id"))
+        # Updates can arrive before the SmartTrade placed by a pair is tracked, keep the latest few for get()
+        if smart_trade_id not in self.next_poll:
+            self.unclaimed[smart_trade_id] = smart_trade
+            self.unclaimed.move_to_end(smart_trade_id)
+            if len(self.unclaimed) > 1000:
+                self.unclaimed.popitem(last=False)
+            return
+        now = asyncio.get_running_loop().time()
+        self.snapshots[smart_trade_id] = smart_trade
+        self.last_polled[smart_trade_id] = now
+        self.next_poll[smart_trade_id] = now + self.get_interval(smart_trade)
+        price, _ = self.get_targets(smart_trade)
+        if price and "pair" in smart_trade:
+            self.bot.price_cache.put(smart_trade["pair"], price)
+        self.resolve(smart_trade_id)
+        # The other leg of the pair is handed its latest snapshot, or polled right away if it has none yet
+        pair = self.pairs.get(smart_trade_id)
+        for other_id in list(self.pair_ids.get(pair, ())):
+            if other_id == smart_trade_id:
+                continue
+            if other_id in self.snapshots:
+                self.resolve(other_id)
+            elif other_id in self.next_poll:
+                self.next_poll[other_id] = now
+                self.wakeup.set()
+
+    # Switch between pushed updates with reconciliation polls and polling every SmartTrade
+    def set_streaming(self, streaming):
+        if streaming == self.streaming:
+            return
+        self.streaming = streaming
+        if streaming:
+            return
+        # Updates may have been missed while the stream was down, bring the reconciliation polls forward
+        now = asyncio.get_running_loop().time()
+        for smart_trade_id, due in self.next_poll.items():
+            smart_trade = self.snapshots.get(smart_trade_id)
+            interval = self.get_interval(smart_trade) if smart_trade else self.check_interval
+            self.next_poll[smart_trade_id] = min(due, now + interval)
+        self.wakeup.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            due_ids = [smart_trade_id for smart_trade_id, due in self.next_poll.items()
+                       if due <= now and self.waiters.get(smart_trade_id)]
+            if due_ids:
+                try:
+                    await self.poll(due_ids)
+                except Exception as e:
+                    self.bot.LOGGER.exception(f'Polling SmartTrades failed: {e}')
+                    await asyncio.sleep(self.check_interval)
+            waiting = [due for smart_trade_id, due in self.next_poll.items() if self.waiters.get(smart_trade_id)]
+            timeout = max(0.0, min(waiting) - loop.time()) if waiting else self.max_interval
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+class SmartTradeStream:
+    """
+    Subscribes to SmartTradesChannel of the 3Commas websocket (ActionCable) and pushes every SmartTrade update to the
+    poller, which wakes the pair right away. When the stream drops or goes silent for StreamTimeout seconds the poller
+    falls back to polling while the stream reconnects. Needs the optional websockets package.
+    """
+    CHANNEL = 'SmartTradesChannel'
+    CHANNEL_PATH = '/smart_trades'
+
+    def __init__(self, bot, connect=None):
+        """
+        :param connect: websocket connect function, defaults to websockets.connect
+        """
+        self.bot = bot
+        self.url = bot.settings.get('StreamURL', 'wss://ws.3commas.io/websocket')
+        self.timeout = bot.settings.get('StreamTimeout', 30)
+        self.max_backoff = bot.settings.get('StreamMaxBackoff', 60)
+        self.connect = connect or (websockets.connect if websockets is not None else None)
+        self.updates = 0
+
+    # ActionCable identifier of the channel, signed with the API secret
+    def get_identifier(self):
+        signature = hmac.new(self.bot.api_secret.encode(), self.CHANNEL_PATH.encode(), hashlib.sha256).hexdigest()
+        return json.dumps({"channel": self.CHANNEL, "users": [{"api_key": self.bot.api_key, "signature": signature}]})
+
+    # Receive frames until the stream drops
+    async def listen(self, ws):
+        identifier = self.get_identifier()
+        await ws.send(json.dumps({"command": "subscribe", "identifier": identifier}))
+        while True:
+            message = json.loads(await asyncio.wait_for(ws.recv(), timeout=self.timeout))
+            message_type = message.get("type")
+            if message_type == 'confirm_subscription':
+                self.bot.LOGGER.info(f'SmartTrade stream subscribed to {self.CHANNEL}')
+                self.bot.poller.set_streaming(True)
+            elif message_type == 'reject_subscription':
+                raise ConnectionError(f'Subscription to {self.CHANNEL} rejected')
+            elif message_type == 'disconnect':
+                raise ConnectionError(f'Disconnected: {message.get("reason")}')
+            elif message.get("identifier") == identifier and isinstance(message.get("message"), dict):
+                self.updates += 1
+                self.bot.poller.push(message["message"])
+
+    async def run(self):
+        if self.connect is None or not self.url:
+            self.bot.LOGGER.info(f'SmartTrade stream disabled, polling SmartTrades every {self.bot.settings["CheckInterval"]} seconds')
+            return
+        backoff = 1
+        while True:
+            try:
+                async with self.connect(self.url) as ws:
+                    backoff = 1
+                    await self.listen(ws)
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                self.bot.LOGGER.info(f'SmartTrade stream silent for {self.timeout} seconds')
+            except Exception as e:
+                self.bot.LOGGER.info(f'SmartTrade stream dropped: {e}')
+            finally:
+                self.bot.poller.set_streaming(False)
+            self.bot.LOGGER.info(f'SmartTrade stream reconnecting in {backoff} seconds, polling SmartTrades meanwhile')
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+
+class PairCache:
+    """
+    Base of the per-pair caches of values fetched from 3Commas. Concurrent misses for the same pair share a single
+    request, which is shielded so that a caller being cancelled does not cancel it for the others.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.batch_size = bot.settings.get('PriceBatchSize', 20)
+        self.pending = {}
+
+    # Fetch the value of a pair, returns None if it could not be fetched
+    async def load(self, pair):
+        raise NotImplementedError
+
+    # Single request per pair, shared by all the callers waiting on it
+    def fetch(self, pair):
+        request = self.pending.get(pair)
+        if request is None:
+            request = asyncio.ensure_future(self.load(pair))
+            self.pending[pair] = request
+            request.add_done_callback(lambda _: self.pending.pop(pair, None))
+        return request
+
+    async def get_shared(self, pair):
+        return await asyncio.shield(self.fetch(pair))
+
+    # Fetch pairs batch_size at a time
+    async def fetch_all(self, pairs):
+        for i in range(0, len(pairs), self.batch_size):
+            await asyncio.gather(*[self.fetch(pair) for pair in pairs[i:i + self.batch_size]])
+
+
+class PriceCache(PairCache):
+    """
+    Process-wide cache of pair prices. Prices younger than the pair's TTL are served from memory, older ones within
+    MaxPriceStaleness are served while a batched background refresh runs, and concurrent misses for the same pair
+    share a single currency_rates request.
+    """
+    def __init__(self, bot):
+        super().__init__(bot)
+        self.ttl = bot.settings.get('PriceTTL', 5)
+        self.pair_ttls = bot.settings.get('PairPriceTTL', {})
+        self.max_staleness = bot.settings.get('MaxPriceStaleness', 30)
+        self.prices = {}
+        self.stale_pairs = set()
+        self.wakeup = asyncio.Event()
+
+    # Store a price, e.g. from a SmartTrade snapshot
+    def put(self, pair, price):
+        self.prices[pair] = (price, monotonic())
+
+    # Get a pair price, fetching it only if the cached one is too old
+    async def get(self, pair):
+        """
+        :param pair: pair to get price of
+        :return: price of the pair, None if it could not be fetched
+        """
+        price, updated_at = self.prices.get(pair, (None, None))
+        if price is not None:
+            age = monotonic() - updated_at
+            if age <= self.pair_ttls.get(pair, self.ttl):
+                return price
+            if age <= self.max_staleness:
+                self.stale_pairs.add(pair)
+                self.wakeup.set()
+                return price
+        return await self.get_shared(pair)
+
+    # The currency_rates response carries the market rules too, they are handed to MarketRules
+    async def load(self, pair):
+        data = await self.bot.run_blocking(self.bot.get_market_rules, pair=pair)
+        if data is None:
+            return None
+        price = self.bot.market_rules.put(pair, data)
+        if price is not None:
+            self.put(pair, price)
+        return price
+
+    # Refresh stale pairs in the background, batch_size pairs at a time
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            stale_pairs = list(self.stale_pairs)
+            self.stale_pairs.clear()
+            await self.fetch_all(stale_pairs)
+
+
+class MarketRules(PairCache):
+    """
+    Cache of the exchange rules of every pair (price step, lot step, minimum lot and notional, maximum leverage), taken
+    from the currency_rates responses PriceCache gets anyway, fetched on their own only for pairs without them and in
+    the background for the ones not seen for MarketRulesTTL seconds, and of the
+    LevelCap ladder of every pair derived from them. A ladder is reused until the price moves more than
+    LadderRepriceTicks price steps from the price it was derived at, so its TP/SL prices are never off by more, or
+    LadderRepricePercent for pairs without a price step.
+    """
+    def __init__(self, bot):
+        super().__init__(bot)
+        self.ttl = bot.settings.get('MarketRulesTTL', 3600)
+        self.reprice_ticks = bot.settings.get('LadderRepriceTicks', 2)
+        self.reprice_percent = bot.settings.get('LadderRepricePercent', 0.05)
+        self.rules = {}
+        self.updated_at = {}
+        self.ladders = {}
+
+    # Rules of a pair, fetched only on first use
+    async def get(self, pair):
+        """
+        :return: rules of the pair, None if they could not be fetched
+        """
+        if pair in self.rules:
+            return self.rules[pair]
+        return await self.get_shared(pair)
+
+    async def load(self, pair):
+        data = await self.bot.run_blocking(self.bot.get_market_rules, pair=pair)
+        if data is None:
+            return None
+        price = self.put(pair, data)
+        if price:
+            self.bot.price_cache.put(pair, price)
+        return self.rules[pair]
+
+    # Store the rules of a pair from get_market_rules, dropping its ladder if they changed
+    def put(self, pair, data):
+        """
+        :param data: dict returned by ThreeCommasBot.get_market_rules
+        :return: price of the pair in data
+        """
+        rules = dict(data)
+        price = rules.pop("price")
+        if rules != self.rules.get(pair):
+            self.ladders.pop(pair, None)
+        self.rules[pair] = rules
+        self.updated_at[pair] = monotonic()
+        return price
+
+    # Ladder of a pair at price, derived again only if the price moved too far
+    async def get_ladder(self, pair, price):
+        """
+        :return: ladder as returned by ThreeCommasBot.get_level_ladder
+        """
+        ladder = self.ladders.get(pair)
+        if ladder is not None:
+            price_step = (self.rules.get(pair) or {}).get("price_step")
+            if price_step:
+                # Half a step of slack for float noise, prices are multiples of the step
+                if abs(price - ladder["price"]) <= (self.reprice_ticks + 0.5) * price_step:
+                    return ladder
+            elif abs(price - ladder["price"]) / ladder["price"] * 100 <= self.reprice_percent:
+                return ladder
+        rules = await self.get(pair)
+        ladder = self.bot.get_level_ladder(pair=pair, pair_price=price, rules=rules)
+        if rules is not None:
+            self.ladders[pair] = ladder
+        return ladder
+
+    # Refresh the rules of the known pairs no price fetch brought in the last MarketRulesTTL seconds
+    async def refresh(self):
+        now = monotonic()
+        await self.fetch_all([pair for pair in self.rules if now - self.updated_at[pair] >= self.ttl])
+
+
+class TelegramNotifier:
+    """
+    Sends Telegram messages from a background thread over a keep-alive session, so the trading loop never waits on
+    Telegram. Messages queued within TelegramCoalesceSeconds of each other go out as one digest, and once the bounded
+    queue is full messages are dropped by TelegramDropPolicy ('oldest' or 'newest').
+    """
+    MAX_MESSAGE_LENGTH = 4096
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.queue = queue.Queue(maxsize=bot.settings.get('TelegramQueueSize', 1000))
+        self.coalesce_seconds = bot.settings.get('TelegramCoalesceSeconds', 2)
+        self.drop_policy = bot.settings.get('TelegramDropPolicy', 'oldest')
+        self.session = None
+        self.thread = None
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    # Queue a message without blocking
+    def notify(self, msg):
+        """
+        :param msg: message text
+        :return: True if the message was queued, False if it was dropped or Telegram is not set up
+        """
+        if not self.bot.settings.get('BotToken'):
+            return False
+        with self.lock:
+            if self.thread is None:
+                self.session = requests.Session()
+                self.thread = threading.Thread(target=self.run, name='TelegramNotifier', daemon=True)
+                self.thread.start()
+            try:
+                self.queue.put_nowait(msg)
+                return True
+            except queue.Full:
+                self.dropped += 1
+                if self.drop_policy != 'oldest':
+                    return False
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(msg)
+            except queue.Full:
+                return False
+            return True
+
+    # Split a digest into chunks Telegram accepts
+    def get_digests(self, messages):
+        digests = []
+        digest = ''
+        for msg in messages:
+            msg = msg[:self.MAX_MESSAGE_LENGTH]
+            if digest and len(digest) + len(msg) + 2 > self.MAX_MESSAGE_LENGTH:
+                digests.append(digest)
+                digest = ''
+            digest = f'{digest}\n\n{msg}' if digest else msg
+        if digest:
+            digests.append(digest)
+        return digests
+
+    def send(self, text):
+        bot_token = self.bot.settings['BotToken']
+        chat_id = self.bot.settings['ChatID']
+        for _ in range(3):
+            try:
+                response = self.session.post(f'https://api.telegram.org/bot{bot_token}/sendMessage',
+                                             data={"chat_id": chat_id, "text": text}, timeout=10)
+                data = response.json()
+            except Exception as e:
+                self.bot.LOGGER.info(f'Sending Telegram message failed with error: {e}')
+                return None
+            if response.status_code != 429:
+                return data
+            sleep(data.get("parameters", {}).get("retry_after", 1))
+        return None
+
+    def run(self):
+        while True:
+            messages = [self.queue.get()]
+            deadline = monotonic() + self.coalesce_seconds
+            while True:
+                timeout = deadline - monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    messages.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            with self.lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                messages.append(f'{dropped} messages dropped, Telegram queue was full')
+            for digest in self.get_digests(messages):
+                self.send(digest)
+
+
+class StateJournal:
+    """
+    Append-only, crash-safe journal of pair states. Every state change is appended as one fsync'd JSON line, the last
+    line of a pair wins on load, and the file is rewritten with one line per pair once it grows past compact_records.
+    Journals of other worker processes can be merged in on load, the record with the latest UpdatedAt of a pair wins,
+    and only the pairs this journal holds the latest record of are kept when it is rewritten.
+    """
+    def __init__(self, file_journal, compact_records=1000):
+        self.file_journal = file_journal
+        self.compact_records = compact_records
+        self.states = {}
+        self.owned = set()
+        self.records = 0
+        self.file = None
+        self.lock = threading.Lock()
+
+    # Rebuild the latest state of every pair from the journal
+    def load(self, files_merge=()):
+        """
+        :param files_merge: journals of other workers to merge in
+        :return: dict of pair: latest state record
+        """
+        with self.lock:
+            self.states = {}
+            self.owned = set()
+            self.records = 0
+            for file_merge in files_merge:
+                if os.path.abspath(file_merge) != os.path.abspath(self.file_journal):
+                    self.read(file_merge)
+            torn = self.read(self.file_journal)
+            if torn:
+                self.rewrite()
+            elif self.file is None:
+                self.file = open(self.file_journal, 'a', encoding='utf-8')
+            return self.states
+
+    # Order of the records of a pair, records of older versions only have a whole-second TimeStamp
+    @staticmethod
+    def get_order(record):
+        return record.get("UpdatedAt", 0.0), record.get("TimeStamp", '')
+
+    # Read the records of a journal into states, caller holds the lock
+    def read(self, file_journal):
+        """
+        :return: True if the last line of the journal is torn
+        """
+        torn = False
+        if not os.path.isfile(file_journal):
+            return torn
+        own = file_journal == self.file_journal
+        with open(file_journal, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    torn = True
+                    continue
+                torn = not line.endswith(b'\n')
+                latest = self.states.get(record["Pair"])
+                if latest is None or self.get_order(record) >= self.get_order(latest):
+                    self.states[record["Pair"]] = record
+                    if own:
+                        self.owned.add(record["Pair"])
+                if own:
+                    self.records += 1
+        return torn
+
+    # Latest state of every pair in journals, without opening any of them for writing
+    @classmethod
+    def read_states(cls, files):
+        """
+        :return: dict of pair: latest state record
+        """
+        journal = cls(file_journal=None)
+        with journal.lock:
+            for file_journal in files:
+                journal.read(file_journal)
+        return journal.states
+
+    def get(self, pair):
+        return self.states.get(pair)
+
+    def append(self, record):
+        """
+        :param record: state of a pair, as returned by PairState.to_dict()
+        """
+        record = dict(record, UpdatedAt=time())
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.file_journal, 'a', encoding='utf-8')
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.states[record["Pair"]] = record
+            self.owned.add(record["Pair"])
+            self.records += 1
+            if self.records >= max(self.compact_records, 2 * len(self.owned)):
+                self.rewrite()
+
+    def compact(self):
+        with self.lock:
+            self.rewrite()
+
+    # Atomically replace the journal with the latest state of every pair it owns, caller holds the lock
+    def rewrite(self):
+        file_tmp = f'{self.file_journal}.tmp'
+        with open(file_tmp, 'w', encoding='utf-8') as f:
+            for pair in self.owned:
+                f.write(json.dumps(self.states[pair], separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if self.file is not None:
+            self.file.close()
+        os.replace(file_tmp, self.file_journal)
+        if hasattr(os, 'O_DIRECTORY'):
+            dir_fd = os.open(os.path.dirname(self.file_journal) or '.', os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        self.file = open(self.file_journal, 'a', encoding='utf-8')
+        self.records = len(self.owned)
+
+
+class StatsStore:
+    """
+    Compact binary store of TP/TSL events. Events are buffered and appended to the file in batches as fixed-size
+    records, while per-pair totals and per-pair time buckets are rolled up as events arrive so summaries never re-read
+    the file. Files start with MAGIC, followed by the records.
+    """
+    MAGIC = b'3CSTATS1'
+    PAIR_BYTES = 32
+    RECORD = struct.Struct(f'<d{PAIR_BYTES}sBBIIId')
+    EVENT_TP = 1
+    EVENT_TSL = 2
+
+    def __init__(self, file_stats, bucket_seconds=3600, batch_size=100):
+        self.file_stats = file_stats
+        self.bucket_seconds = bucket_seconds
+        self.batch_size = batch_size
+        self.buffer = []
+        self.totals = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_rollup():
+        return {"Trades": 0, "MaxLevel": 0, "TP": 0, "TSL": 0, "PnL": 0.0}
+
+    # Rebuild rollups from the stats file
+    def load(self, files=None):
+        """
+        :param files: stats files to read, e.g. of all the workers, defaults to file_stats
+        """
+        for file_stats in files or [self.file_stats]:
+            if not os.path.isfile(file_stats):
+                continue
+            with open(file_stats, 'rb') as f:
+                data = f.read()
+            if not data.startswith(self.MAGIC):
+                continue
+            data = data[len(self.MAGIC):]
+            data = data[:len(data) - len(data) % self.RECORD.size]
+            with self.lock:
+                for record in self.RECORD.iter_unpack(data):
+                    self.add(*record)
+
+    # Update rollups with one event, caller holds the lock
+    def add(self, time_stamp, pair, event, level, trade_count, tp_count, tsl_count, pnl):
+        pair = pair.rstrip(b'\0').decode()
+        bucket = int(time_stamp // self.bucket_seconds)
+        pair_buckets = self.buckets.setdefault(pair, {})
+        for rollup in (self.totals.setdefault(pair, self.get_rollup()),
+                       pair_buckets.setdefault(bucket, self.get_rollup())):
+            rollup["Trades"] += 2
+            rollup["MaxLevel"] = max(rollup["MaxLevel"], level)
+            rollup["TP" if event == self.EVENT_TP else "TSL"] += 1
+            rollup["PnL"] += pnl
+
+    # Record a TP/TSL event of a pair
+    def record(self, state, event):
+        """
+        :param state: PairState at the time of the event
+        :param event: StatsStore.EVENT_TP or StatsStore.EVENT_TSL
+        """
+        pair = state.pair.encode()
+        if len(pair) > self.PAIR_BYTES:
+            raise ValueError(f'Pair {state.pair} is longer than {self.PAIR_BYTES} bytes')
+        record = (time(), pair, event, state.level, state.trade_count, state.tp_count,
+                  state.tsl_count, float(state.pnls[state.level]))
+        with self.lock:
+            self.add(*record)
+            self.buffer.append(self.RECORD.pack(*record))
+            if len(self.buffer) < self.batch_size:
+                return
+        self.flush()
+
+    # Append buffered events to the stats file
+    def flush(self):
+        with self.lock:
+            buffer, self.buffer = self.buffer, []
+        if buffer:
+            with open(self.file_stats, 'ab') as f:
+                if f.tell() == 0:
+                    f.write(self.MAGIC)
+                f.write(b''.join(buffer))
+
+    # Summary of a pair over the last hours
+    def get_summary(self, pair, hours=None):
+        """
+        :param pair: pair to summarize
+        :param hours: look back window, None for all time
+        :return: dict of Trades, MaxLevel, TP, TSL, PnL
+        """
+        with self.lock:
+            if hours is None:
+                return dict(self.totals.get(pair, self.get_rollup()))
+            summary = self.get_rollup()
+            pair_buckets = self.buckets.get(pair, {})
+            # The current bucket and the ones before it, hours worth of buckets in all
+            last_bucket = int(time() // self.bucket_seconds)
+            bucket_count = max(1, math.ceil(hours * 3600 / self.bucket_seconds))
+            for bucket in range(last_bucket - bucket_count + 1, last_bucket + 1):
+                rollup = pair_buckets.get(bucket)
+                if rollup is None:
+                    continue
+                summary["Trades"] += rollup["Trades"]
+                summary["MaxLevel"] = max(summary["MaxLevel"], rollup["MaxLevel"])
+                summary["TP"] += rollup["TP"]
+                summary["TSL"] += rollup["TSL"]
+                summary["PnL"] += rollup["PnL"]
+            return summary
+
+
+class SyncStore:
+    """
+    Local SQLite copy of the deals, SmartTrades and bot stats of the API key, indexed by pair, bot, account and update
+    time. Every sync only fetches the records updated since the cursor it left, reports query the local copy.
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS deals (id INTEGER PRIMARY KEY, bot_id INTEGER, account_id INTEGER, pair TEXT,
+            status TEXT, created_at TEXT, updated_at TEXT, closed_at TEXT, profit_usd REAL, data TEXT);
+        CREATE INDEX IF NOT EXISTS deals_pair ON deals (pair, closed_at);
+        CREATE INDEX IF NOT EXISTS deals_bot ON deals (bot_id, updated_at);
+        CREATE TABLE IF NOT EXISTS smart_trades (id INTEGER PRIMARY KEY, account_id INTEGER, pair TEXT, status TEXT,
+            created_at TEXT, updated_at TEXT, closed_at TEXT, profit_usd REAL, data TEXT);
+        CREATE INDEX IF NOT EXISTS smart_trades_pair ON smart_trades (pair, updated_at);
+        CREATE INDEX IF NOT EXISTS smart_trades_account ON smart_trades (account_id, updated_at);
+        CREATE TABLE IF NOT EXISTS bot_stats (bot_id INTEGER PRIMARY KEY, fetched_at REAL, data TEXT);
+        CREATE TABLE IF NOT EXISTS cursors (name TEXT PRIMARY KEY, value TEXT);
+    '''
+
+    def __init__(self, file_db):
+        self.file_db = file_db
+        self.connection = None
+        self.lock = threading.Lock()
+
+    # Open the database on first use, shared by the executor threads
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.file_db, timeout=30, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.executescript(self.SCHEMA)
+        return self.connection
+
+    @staticmethod
+    def get_updated_at(record):
+        """
+        :param record: deal or SmartTrade
+        :return: last update time of the record as an ISO string, None if it has none
+        """
+        data = record.get("data") or {}
+        return record.get("updated_at") or data.get("updated_at") or record.get("closed_at") or data.get("closed_at") \
+            or record.get("created_at") or data.get("created_at")
+
+    def get_cursor(self, name):
+        with self.lock:
+            row = self.connect().execute('SELECT value FROM cursors WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, name, value):
+        with self.lock, self.connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO cursors (name, value) VALUES (?, ?)', (name, value))
+
+    def put_deals(self, deals):
+        rows = [(deal["id"], deal.get("bot_id"), deal.get("account_id"), deal.get("pair"), deal.get("status"),
+                 deal.get("created_at"), self.get_updated_at(deal), deal.get("closed_at"),
+                 float(deal.get("usd_final_profit") or deal.get("final_profit") or 0), json.dumps(deal))
+                for deal in deals]
+        with self.lock, self.connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO deals VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def put_smart_trades(self, smart_trades):
+        rows = []
+        for smart_trade in smart_trades:
+            data = smart_trade.get("data") or {}
+            rows.append((smart_trade["id"], (smart_trade.get("account") or {}).get("id"), smart_trade.get("pair"),
+                         (smart_trade.get("status") or {}).get("type"), smart_trade.get("created_at") or data.get("created_at"),
+                         self.get_updated_at(smart_trade), smart_trade.get("closed_at") or data.get("closed_at"),
+                         float((smart_trade.get("profit") or {}).get("usd") or 0), json.dumps(smart_trade)))
+        with self.lock, self.connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO smart_trades VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def put_bot_stats(self, bot_id, stats):
+        with self.lock, self.connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO bot_stats VALUES (?, ?, ?)', (bot_id, time(), json.dumps(stats)))
+
+    def get_bot_ids(self):
+        with self.lock:
+            return {row[0] for row in self.connect().execute('SELECT bot_id FROM bot_stats')}
+
+    # Count, open count and PnL of every pair of a table
+    def get_pair_summary(self, table, since=None):
+        """
+        :param table: deals or smart_trades
+        :param since: only records updated at or after this ISO time
+        :return: list of (pair, count, open count, PnL) tuples
+        """
+        is_open = "closed_at IS NULL AND status NOT IN ('completed', 'cancelled', 'failed', 'panic_sold', 'stop_loss_finished')"
+        with self.lock:
+            return self.connect().execute(
+                f'SELECT pair, COUNT(*), SUM({is_open}), SUM(profit_usd) FROM {table} '
+                f'WHERE updated_at >= ? GROUP BY pair ORDER BY pair', (since or '',)).fetchall()
+
+
+class Metrics:
+    """
+    Latency histograms, error codes, retries and payload sizes of every 3Commas entity/action, and loop lag of every
+    pair, rendered in the Prometheus text format or as a log summary.
+    """
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
     def __init__(self):
+        self.endpoints = {}
+        self.pairs = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def get_histogram(self):
+        return {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * (len(self.BUCKETS) + 1)}
+
+    # Add a value to a histogram, caller holds the lock
+    def add(self, histogram, value):
+        histogram["count"] += 1
+        histogram["sum"] += value
+        histogram["max"] = max(histogram["max"], value)
+        histogram["buckets"][bisect.bisect_left(self.BUCKETS, value)] += 1
+
+    # Upper bound of the bucket holding the given percentile
+    def get_percentile(self, histogram, percent):
+        rank = percent / 100 * histogram["count"]
+        seen = 0
+        for bound, count in zip(self.BUCKETS + (histogram["max"],), histogram["buckets"]):
+            seen += count
+            if seen >= rank and count:
+                return round(min(bound, histogram["max"]), 3)
+        return round(histogram["max"], 3)
+
+    def get_endpoint(self, entity, action):
+        endpoint = self.endpoints.get((entity, action))
+        if endpoint is None:
+            endpoint = {"latency": self.get_histogram(), "errors": {}, "retries": 0, "request_bytes": 0,
+                        "response_bytes": 0}
+            self.endpoints[(entity, action)] = endpoint
+        return endpoint
+
+    def observe_request(self, entity, action, seconds, status_code, request_bytes, response_bytes):
+        with self.lock:
+            endpoint = self.get_endpoint(entity, action)
+            self.add(endpoint["latency"], seconds)
+            endpoint["errors"][status_code] = endpoint["errors"].get(status_code, 0) + 1
+            endpoint["request_bytes"] += request_bytes
+            endpoint["response_bytes"] += response_bytes
+
+    def observe_retry(self, entity, action):
+        with self.lock:
+            self.get_endpoint(entity, action)["retries"] += 1
+
+    # Record how late a pair tick was against its scheduled interval
+    def observe_loop_lag(self, pair, lag, interval):
+        """
+        :param pair: pair that ticked
+        :param lag: seconds the tick came after it was due
+        :param interval: seconds since the previous tick of the pair
+        """
+        with self.lock:
+            pair_metrics = self.pairs.get(pair)
+            if pair_metrics is None:
+                pair_metrics = self.pairs[pair] = {"lag": self.get_histogram(), "interval": 0.0}
+            self.add(pair_metrics["lag"], max(lag, 0.0))
+            pair_metrics["interval"] = interval
+
+    # Metrics in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, histograms in (
+                    ('threecommas_request_seconds', [({"entity": entity, "action": action}, endpoint["latency"])
+                                                     for (entity, action), endpoint in self.endpoints.items()]),
+                    ('threecommas_pair_loop_lag_seconds', [({"pair": pair}, pair_metrics["lag"])
+                                                           for pair, pair_metrics in self.pairs.items()])):
+                lines.append(f'# TYPE {name} histogram')
+                for labels, histogram in histograms:
+                    label_text = ','.join(f'{key}="{value}"' for key, value in labels.items())
+                    cumulative = 0
+                    for bound, count in zip(self.BUCKETS + ('+Inf',), histogram["buckets"]):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{{label_text}}} {histogram["sum"]}')
+                    lines.append(f'{name}_count{{{label_text}}} {histogram["count"]}')
+            lines.append('# TYPE threecommas_requests_total counter')
+            lines.append('# TYPE threecommas_request_retries_total counter')
+            lines.append('# TYPE threecommas_request_bytes_total counter')
+            lines.append('# TYPE threecommas_response_bytes_total counter')
+            for (entity, action), endpoint in self.endpoints.items():
+                label_text = f'entity="{entity}",action="{action}"'
+                for status_code, count in endpoint["errors"].items():
+                    lines.append(f'threecommas_requests_total{{{label_text},status="{status_code}"}} {count}')
+                lines.append(f'threecommas_request_retries_total{{{label_text}}} {endpoint["retries"]}')
+                lines.append(f'threecommas_request_bytes_total{{{label_text}}} {endpoint["request_bytes"]}')
+                lines.append(f'threecommas_response_bytes_total{{{label_text}}} {endpoint["response_bytes"]}')
+            lines.append('# TYPE threecommas_pair_tick_interval_seconds gauge')
+            for pair, pair_metrics in self.pairs.items():
+                lines.append(f'threecommas_pair_tick_interval_seconds{{pair="{pair}"}} {pair_metrics["interval"]}')
+        return '\n'.join(lines) + '\n' + ''.join(collector() for collector in self.collectors)
+
+    # One line per endpoint and the pairs lagging the most, for the log
+    def get_summary(self, top_pairs=5):
+        lines = []
+        with self.lock:
+            for (entity, action), endpoint in sorted(self.endpoints.items()):
+                latency = endpoint["latency"]
+                errors = {status_code: count for status_code, count in endpoint["errors"].items() if status_code != 200}
+                lines.append(f'{entity}/{action}: {latency["count"]} calls | p50 <= {self.get_percentile(latency, 50)}s '
+                             f'p99 <= {self.get_percentile(latency, 99)}s max {round(latency["max"], 3)}s | '
+                             f'errors: {errors} | retries: {endpoint["retries"]} | '
+                             f'bytes out/in: {endpoint["request_bytes"]}/{endpoint["response_bytes"]}')
+            lagging = sorted(self.pairs.items(), key=lambda item: item[1]["lag"]["max"], reverse=True)[:top_pairs]
+            for pair, pair_metrics in lagging:
+                lag = pair_metrics["lag"]
+                lines.append(f'Pair: {pair} | loop lag p99 <= {self.get_percentile(lag, 99)}s max {round(lag["max"], 3)}s '
+                             f'| last tick interval {round(pair_metrics["interval"], 3)}s')
+        return lines
+
+    # Serve render() at http://<host>:<port>/metrics from a background thread
+    def serve(self, port, host='127.0.0.1'):
+        metrics = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] == '/metrics':
+                    body = metrics.render().encode()
+                    self.send_response(200)
+                else:
+                    body = b'Not found\n'
+                    self.send_response(404)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+        return server
+
+
+class InstrumentedClient:
+    """
+    Wraps a Py3CW client and records latency, status code and payload sizes of every request in Metrics
+    """
+    def __init__(self, client, metrics):
+        self.client = client
+        self.metrics = metrics
+
+    def request(self, entity, action='', action_id=None, payload=None, **kwargs):
+        start = monotonic()
+        error, data = self.client.request(entity=entity, action=action, action_id=action_id, payload=payload, **kwargs)
+        seconds = monotonic() - start
+        status_code = (error.get("status_code") or 'error') if error else 200
+        self.metrics.observe_request(entity=entity, action=action, seconds=seconds, status_code=status_code,
+                                     request_bytes=len(json.dumps(payload)) if payload else 0,
+                                     response_bytes=len(json.dumps(data)) if data else 0)
+        return error, data
+
+
+class RecordingClient:
+    """
+    Wraps a Py3CW client and records every request with its response and timings to a gzipped JSON lines file, for
+    3CommasReplay.py to run the bot against later. Each line has T (seconds from the start of the recording to the
+    request), D (seconds it took), E, A, I and P (entity, action, action_id and payload) and Err and R (error and
+    data). Every run starts with a Session line, and run_pairs() adds a Start line with the pairs, their saved states
+    and the settings.
+    """
+    PRIVATE_SETTINGS = ('APIKey', 'APISecret', 'BotToken', 'ChatID', 'AccountSets')
+
+    def __init__(self, client, file_record):
+        self.client = client
+        self.file_record = file_record
+        self.file = gzip.open(file_record, 'at', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.started_at = monotonic()
+        self.records = 0
+        self.write({"T": 0.0, "Session": datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line)
+                self.records += 1
+
+    def request(self, entity, action='', action_id=None, payload=None, **kwargs):
+        start = monotonic()
+        error, data = self.client.request(entity=entity, action=action, action_id=action_id, payload=payload, **kwargs)
+        record = {"T": round(start - self.started_at, 4), "D": round(monotonic() - start, 4), "E": entity, "A": action}
+        if action_id is not None:
+            record["I"] = action_id
+        if payload is not None:
+            record["P"] = payload
+        if error:
+            record["Err"] = error
+        record["R"] = data
+        self.write(record)
+        return error, data
+
+    # Pairs the bot starts trading, with their saved states and the settings, secrets left out
+    def start(self, pairs, states, settings):
+        self.write({"T": round(monotonic() - self.started_at, 4), "Start": {
+            "Pairs": list(pairs), "States": states,
+            "Settings": {key: value for key, value in settings.items() if key not in self.PRIVATE_SETTINGS}}})
+
+    # Make the records so far readable, gzip keeps the rest of the block buffered otherwise
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class RequestScheduler:
+    """
+    Token bucket shared by every pair and account of a 3Commas API key. Requests wait for a token in priority order,
+    so order placement goes first, then deal updates, status polls, price fetches and balance/stats reads, and the
+    lower classes can not spend the last ReservedOrderTokens tokens. A 429 pauses the whole bucket with an
+    exponential backoff before the request is retried. Server errors are only retried for reads, an order or deal
+    update answered with one may still have gone through, so it is returned for the caller to check.
+    """
+    PRIORITY_ORDER = 0
+    PRIORITY_DEAL_UPDATE = 1
+    PRIORITY_STATUS = 2
+    PRIORITY_PRICE = 3
+    PRIORITY_READ = 4
+    PRIORITY_NAMES = ('Order', 'DealUpdate', 'Status', 'Price', 'Read')
+    PRIORITIES = {
+        ('smart_trades_v2', 'new'): PRIORITY_ORDER,
+        ('smart_trades_v2', 'cancel'): PRIORITY_ORDER,
+        ('smart_trades_v2', 'close_by_market'): PRIORITY_ORDER,
+        ('deals', 'update_deal'): PRIORITY_DEAL_UPDATE,
+        ('smart_trades_v2', ''): PRIORITY_STATUS,
+        ('smart_trades_v2', 'get_by_id'): PRIORITY_STATUS,
+        ('accounts', 'currency_rates'): PRIORITY_PRICE,
+    }
+    WRITES = frozenset({('smart_trades_v2', 'new'), ('smart_trades_v2', 'cancel'),
+                        ('smart_trades_v2', 'close_by_market'), ('deals', 'update_deal')})
+
+    def __init__(self, client, rate, burst, reserved_tokens=2, max_retries=5, metrics=None, retry_status_codes=(502,),
+                 retry_backoff=0.1):
+        """
+        :param client: client to send the requests with, e.g. InstrumentedClient
+        :param rate: tokens added per second
+        :param burst: bucket size
+        :param reserved_tokens: tokens only order placement may spend
+        :param max_retries: retries of a request answered with 429 or one of retry_status_codes
+        :param retry_status_codes: server errors of reads retried after retry_backoff seconds, doubled every retry
+        """
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self.reserved_tokens = min(reserved_tokens, burst - 1)
+        self.max_retries = max_retries
+        self.retry_status_codes = tuple(retry_status_codes)
+        self.retry_backoff = retry_backoff
+        self.metrics = metrics
+        self.tokens = float(burst)
+        self.updated_at = monotonic()
+        self.blocked_until = 0.0
+        self.backoff = 0.0
+        self.throttled = 0
+        self.used = collections.deque(maxlen=int(rate * 60 + burst))
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    # caller holds the condition
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # Block until the request is first in line and a token is free
+    def acquire(self, priority):
+        """
+        :return: number of 429s seen so far, for success() to tell whether one came in while the request was out
+        """
+        with self.condition:
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+            needed = 1 + (self.reserved_tokens if priority > self.PRIORITY_ORDER else 0)
+            while True:
+                self.refill()
+                now = monotonic()
+                if self.waiting[0] == ticket and now >= self.blocked_until and self.tokens >= needed:
+                    heapq.heappop(self.waiting)
+                    self.tokens -= 1
+                    self.used.append(now)
+                    self.condition.notify_all()
+                    return self.throttled
+                if self.waiting[0] != ticket:
+                    timeout = None
+                elif now < self.blocked_until:
+                    timeout = self.blocked_until - now
+                else:
+                    timeout = (needed - self.tokens) / self.rate
+                self.condition.wait(timeout)
+
+    # Pause every request after a 429
+    def throttle(self):
+        with self.condition:
+            self.throttled += 1
+            self.backoff = min(60.0, self.backoff * 2 if self.backoff else 1.0)
+            self.blocked_until = max(self.blocked_until, monotonic() + self.backoff)
+            self.tokens = 0.0
+
+    # Clear the 429 backoff after a success, unless another 429 came in since the request was sent
+    def success(self, throttled):
+        with self.condition:
+            if self.throttled == throttled:
+                self.backoff = 0.0
+
+    def request(self, entity, action='', action_id=None, payload=None, priority=None, **kwargs):
+        """
+        :param priority: priority class instead of the one of the endpoint, e.g. PRIORITY_READ for background syncs
+        """
+        if priority is None:
+            priority = self.PRIORITIES.get((entity, action), self.PRIORITY_READ)
+        retry_status_codes = () if (entity, action) in self.WRITES else self.retry_status_codes
+        for retry in range(self.max_retries + 1):
+            throttled = self.acquire(priority)
+            error, data = self.client.request(entity=entity, action=action, action_id=action_id, payload=payload,
+                                              **kwargs)
+            status_code = error.get("status_code") if error else None
+            if status_code != 429 and status_code not in retry_status_codes:
+                if not error:
+                    self.success(throttled)
+                return error, data
+            if status_code == 429:
+                self.throttle()
+            elif retry < self.max_retries:
+                # Only this request waits out a server error, the rest of the budget keeps going
+                sleep(self.retry_backoff * 2 ** retry)
+            if self.metrics is not None and retry < self.max_retries:
+                self.metrics.observe_retry(entity=entity, action=action)
+        return error, data
+
+    # Live view of the request budget
+    def get_budget(self):
+        with self.condition:
+            self.refill()
+            now = monotonic()
+            waiting = collections.Counter(self.PRIORITY_NAMES[priority] for priority, _ in self.waiting)
+            return {"Rate": self.rate, "Burst": self.burst, "Tokens": round(self.tokens, 2),
+                    "UsedLastMinute": sum(1 for used_at in self.used if now - used_at <= 60),
+                    "Waiting": dict(waiting), "BackoffSeconds": round(max(0.0, self.blocked_until - now), 2),
+                    "Throttled": self.throttled}
+
+    # Budget gauges in the Prometheus text format
+    def render(self):
+        budget = self.get_budget()
+        lines = ['# TYPE threecommas_budget_tokens gauge', f'threecommas_budget_tokens {budget["Tokens"]}',
+                 '# TYPE threecommas_budget_used_last_minute gauge',
+                 f'threecommas_budget_used_last_minute {budget["UsedLastMinute"]}',
+                 '# TYPE threecommas_budget_backoff_seconds gauge',
+                 f'threecommas_budget_backoff_seconds {budget["BackoffSeconds"]}',
+                 '# TYPE threecommas_budget_throttled_total counter',
+                 f'threecommas_budget_throttled_total {budget["Throttled"]}',
+                 '# TYPE threecommas_budget_waiting gauge']
+        for name in self.PRIORITY_NAMES:
+            lines.append(f'threecommas_budget_waiting{{priority="{name}"}} {budget["Waiting"].get(name, 0)}')
+        return '\n'.join(lines) + '\n'
+
+
+class ExposureEngine:
+    """
+    Running notional, margin used and unrealized PnL of every account and of the long and short leg of every pair.
+    A fill or SmartTrade update changes the account totals by the difference it makes, and balances come from
+    load_balances refreshed in the background every BalanceRefreshSeconds, so checking a new level against the
+    available margin takes no request. The event loop updates it while the metrics server reads it, so every access
+    holds the lock.
+    Workers sharing an account keep the margin of their positions in file_db as well. A new level is checked against
+    the margin of the other workers and reserved in the same transaction, so together they never commit more than
+    the account has. Rows of a worker that stopped refreshing them are left out after three balance refreshes.
+    """
+    EMPTY_TOTALS = {"Notional": 0.0, "Margin": 0.0, "PnL": 0.0}
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS margins (account_id TEXT, pair TEXT, side TEXT, worker TEXT, margin REAL,
+            updated_at REAL, PRIMARY KEY (account_id, pair, side));
+        CREATE INDEX IF NOT EXISTS margins_worker ON margins (worker, updated_at);
+    '''
+
+    def __init__(self, bot, file_db=None):
+        """
+        :param file_db: SQLite file shared with the other workers, None to only count the margin of this one
+        """
+        self.bot = bot
+        self.refresh_seconds = bot.settings.get('BalanceRefreshSeconds', 60)
+        self.buffer_percent = bot.settings.get('MarginBufferPercent', 10)
+        self.file_db = file_db
+        self.worker = bot.worker or ''
+        self.connection = None
+        self.balances = {}
+        self.realized = {}
+        self.totals = {}
+        self.positions = {}
+        self.shared = {}
+        self.others = {}
+        self.blocked = {}
+        self.lock = threading.RLock()
+
+    # Open the shared database on first use, dropping the rows left by an earlier run of this worker
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.file_db, timeout=30, isolation_level=None, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.executescript(self.SCHEMA)
+            self.connection.execute('DELETE FROM margins WHERE worker = ?', (self.worker,))
+        return self.connection
+
+    # Margin of the other workers per account, caller holds the lock
+    def load_others(self):
+        rows = self.connect().execute('SELECT account_id, SUM(margin) FROM margins WHERE worker != ? AND updated_at >= ? '
+                                      'GROUP BY account_id', (self.worker, time() - 3 * self.refresh_seconds))
+        self.others = {account_id: margin for account_id, margin in rows}
+
+    # Write the margin of a leg to the shared database if it changed, None to delete it, caller holds the lock
+    def share(self, account_id, pair, side, margin):
+        key = (account_id, pair, side)
+        if self.file_db is None:
+            return
+        if margin is None:
+            if self.shared.pop(key, None) is not None:
+                self.connect().execute('DELETE FROM margins WHERE account_id = ? AND pair = ? AND side = ?', key)
+            return
+        # SmartTrade updates move the margin a little on every check, only a change of more than 1% is written
+        if key in self.shared and abs(self.shared[key] - margin) <= margin / 100:
+            return
+        self.connect().execute('INSERT OR REPLACE INTO margins VALUES (?, ?, ?, ?, ?, ?)',
+                               (*key, self.worker, margin, time()))
+        self.shared[key] = margin
+
+    # Keep the rows of this worker fresh and reload the margin of the others
+    def sync_shared(self):
+        if self.file_db is None:
+            return
+        with self.lock:
+            self.connect().execute('UPDATE margins SET updated_at = ? WHERE worker = ?', (time(), self.worker))
+            self.load_others()
+
+    # Totals of an account, zero for an account without positions
+    def get_totals(self, account_id):
+        with self.lock:
+            return dict(self.totals.get(account_id, self.EMPTY_TOTALS))
+
+    def add(self, account_id, position, sign):
+        totals = self.totals.setdefault(account_id, dict(self.EMPTY_TOTALS))
+        for key in totals:
+            totals[key] += sign * position[key]
+
+    # Replace the position of a leg of a pair on an account
+    def set_position(self, account_id, pair, side, smart_trade_id, notional, margin, pnl=0.0):
+        """
+        :param side: 'long' or 'short', both legs of a pair may be on the same account
+        """
+        account_id = str(account_id)
+        with self.lock:
+            position = self.positions.get((account_id, pair, side))
+            if position is not None:
+                self.add(account_id, position, -1)
+            position = {"ID": smart_trade_id, "Notional": notional, "Margin": margin, "PnL": pnl}
+            self.positions[(account_id, pair, side)] = position
+            self.add(account_id, position, 1)
+            self.share(account_id, pair, side, margin)
+
+    def remove_position(self, account_id, pair, side):
+        with self.lock:
+            position = self.positions.pop((str(account_id), pair, side), None)
+            if position is not None:
+                self.add(str(account_id), position, -1)
+                self.share(str(account_id), pair, side, None)
+            return position
+
+    def set_balance(self, account_id, balance):
+        with self.lock:
+            self.balances[str(account_id)] = balance
+            self.realized[str(account_id)] = 0.0
+
+    # Margin left on an account, None before its balance is known
+    def get_available(self, account_id):
+        account_id = str(account_id)
+        with self.lock:
+            if account_id not in self.balances:
+                return None
+            totals = self.totals.get(account_id, self.EMPTY_TOTALS)
+            return (self.balances[account_id] + self.realized.get(account_id, 0.0) + min(0.0, totals["PnL"])
+                    - totals["Margin"] - self.others.get(account_id, 0.0))
+
+    # Reserve the margin of the legs of a new level, before it is placed
+    def reserve(self, pair, notional, leverage, legs):
+        """
+        :param legs: dict of side: account_id
+        :return: list of the accounts short of margin, nothing is reserved unless it is empty
+        """
+        margin = notional / leverage
+        required = collections.Counter()
+        for account_id in legs.values():
+            required[str(account_id)] += margin * (1 + self.buffer_percent / 100)
+        with self.lock:
+            # The other workers can not reserve between the check and the reservation
+            if self.file_db is not None:
+                self.connect().execute('BEGIN IMMEDIATE')
+            try:
+                if self.file_db is not None:
+                    self.load_others()
+                short = [account_id for account_id, amount in required.items()
+                         if self.get_available(account_id) is not None and self.get_available(account_id) < amount]
+                if not short:
+                    for side, account_id in legs.items():
+                        self.set_position(account_id, pair, side, None, notional, margin)
+                else:
+                    self.blocked[pair] = self.blocked.get(pair, 0) + 1
+            finally:
+                if self.file_db is not None:
+                    self.connect().execute('COMMIT')
+            return short
+
+    # Size of an open SmartTrade from its snapshot, the one it was placed with if the snapshot has none
+    @staticmethod
+    def get_size(smart_trade, position):
+        try:
+            notional = float(smart_trade["position"]["units"]["value"]) * float(smart_trade["position"]["price"]["value"])
+            leverage = float((smart_trade.get("leverage") or {}).get("value") or 1)
+            return notional, notional / leverage
+        except (KeyError, TypeError, ValueError, ZeroDivisionError):
+            if position is None:
+                return 0.0, 0.0
+            return position["Notional"], position["Margin"]
+
+    # Apply a SmartTrade snapshot of a leg, moving its PnL to the realized PnL of the account once it has closed
+    def update(self, account_id, pair, side, smart_trade):
+        account_id = str(account_id)
+        smart_trade_id = str(smart_trade["id"])
+        pnl = float(smart_trade["profit"]["usd"])
+        outcome = self.bot.get_smart_trade_outcome(smart_trade)
+        with self.lock:
+            position = self.positions.get((account_id, pair, side))
+            if outcome == 'open':
+                notional, margin = self.get_size(smart_trade, position)
+                self.set_position(account_id, pair, side, smart_trade_id, notional, margin, pnl)
+            elif position is not None and position["ID"] == smart_trade_id:
+                self.remove_position(account_id, pair, side)
+                self.realized[account_id] = self.realized.get(account_id, 0.0) + pnl
+
+    # Remove a leg the bot closed itself, realizing its PnL even if the snapshot does not show it closed yet
+    def close(self, account_id, pair, side, smart_trade):
+        with self.lock:
+            position = self.positions.get((str(account_id), pair, side))
+            if position is not None and position["ID"] == str(smart_trade["id"]):
+                self.remove_position(account_id, pair, side)
+                self.realized[str(account_id)] = self.realized.get(str(account_id), 0.0) + float(smart_trade["profit"]["usd"])
+
+    async def refresh(self):
+        for account_id in dict.fromkeys([self.bot.settings['AccountIDLong'], self.bot.settings['AccountIDShort']]):
+            balance = await self.bot.run_blocking(self.bot.get_account_balance, account_id=account_id)
+            if balance is not None:
+                self.set_balance(account_id, balance)
+        await self.bot.run_blocking(self.sync_shared)
+
+    # Balance, available margin and totals of every account, taken at once
+    def get_snapshot(self):
+        with self.lock:
+            return {account_id: dict(self.totals.get(account_id, self.EMPTY_TOTALS), Balance=self.balances.get(account_id),
+                                     Available=self.get_available(account_id))
+                    for account_id in sorted(set(self.balances) | set(self.totals))}
+
+    def get_summary(self):
+        with self.lock:
+            blocked = sum(self.blocked.values())
+        return [f'Levels blocked by margin: {blocked}'] + [f'Account: {account_id} | Balance: {account["Balance"]} | Available: {round(account["Available"], 2)} | '
+                f'Notional: {round(account["Notional"], 2)} | Margin: {round(account["Margin"], 2)} | '
+                f'Unrealized PnL: {round(account["PnL"], 2)}'
+                for account_id, account in self.get_snapshot().items() if account["Balance"] is not None]
+
+    def render(self):
+        snapshot = self.get_snapshot()
+        with self.lock:
+            blocked = dict(self.blocked)
+        lines = ['# TYPE threecommas_margin_blocked_total counter']
+        lines.extend(f'threecommas_margin_blocked_total{{pair="{pair}"}} {count}' for pair, count in sorted(blocked.items()))
+        for name, key in (('balance', 'Balance'), ('available', 'Available'), ('notional', 'Notional'),
+                          ('margin_used', 'Margin'), ('unrealized_pnl', 'PnL')):
+            lines.append(f'# TYPE threecommas_account_{name} gauge')
+            for account_id, account in snapshot.items():
+                if account[key] is not None:
+                    lines.append(f'threecommas_account_{name}{{account="{account_id}"}} {round(account[key], 8)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Timer:
+    """
+    Callback of the TimerWheel, due at tick due and every interval ticks after it if interval is set
+    """
+    def __init__(self, name, due, interval, callback):
+        self.name = name
+        self.due = due
+        self.interval = interval
+        self.callback = callback
+        self.cancelled = False
+        self.task = None
+        self.skipped = 0
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel running the periodic work of the bot and of every pair (heartbeats, balance and market
+    rules refresh, stats flushes, sync) from one task. Timers sit in the slot of the tick they are due at, on LEVELS
+    wheels of SLOTS slots each, so adding, cancelling and firing a timer costs the same however many timers there are
+    and a tick only looks at the slot it reaches. A timer never fires before it is due and is never missed: ticks the
+    event loop was too busy for are caught up in order. A coroutine still running when its timer is due again is not
+    started twice, the run is counted as skipped instead.
+    """
+    SLOTS = 64
+    LEVELS = 4
+
+    def __init__(self, bot, tick=1.0):
+        """
+        :param tick: resolution in seconds, intervals are rounded up to whole ticks
+        """
+        self.bot = bot
+        self.tick = tick
+        self.wheels = [[[] for _ in range(self.SLOTS)] for _ in range(self.LEVELS)]
+        self.ticks = 0
+        self.started_at = None
+        self.timers = 0
+        self.fired = 0
+
+    # Tick a delay from now is due at, never earlier than the delay
+    def get_due(self, delay):
+        loop_time = asyncio.get_running_loop().time()
+        if self.started_at is None:
+            self.started_at = loop_time
+        return max(self.ticks + 1, self.get_ticks(loop_time + delay - self.started_at))
+
+    # Whole ticks in seconds, rounded up but not for float noise
+    def get_ticks(self, seconds):
+        return max(1, math.ceil(round(seconds / self.tick, 9)))
+
+    # Put a timer in the slot of the lowest wheel that reaches its due tick
+    def insert(self, timer):
+        delta = min(timer.due - self.ticks, self.SLOTS ** self.LEVELS - 1)
+        level = 0
+        while delta >= self.SLOTS ** (level + 1):
+            level += 1
+        due = self.ticks + delta
+        self.wheels[level][due // self.SLOTS ** level % self.SLOTS].append(timer)
+
+    # Run callback after delay seconds, then every interval seconds if interval is set
+    def add(self, callback, delay, interval=None, name=None):
+        """
+        :param callback: function or coroutine function taking no arguments
+        :return: Timer, to cancel
+        """
+        timer = Timer(name=name or getattr(callback, '__name__', 'timer'), due=self.get_due(delay),
+                      interval=self.get_ticks(interval) if interval is not None else None, callback=callback)
+        self.insert(timer)
+        self.timers += 1
+        return timer
+
+    # Run callback every interval seconds, the first time after delay seconds (interval by default)
+    def every(self, interval, callback, delay=None, name=None):
+        return self.add(callback=callback, delay=interval if delay is None else delay, interval=interval, name=name)
+
+    def cancel(self, timer):
+        if timer is not None and not timer.cancelled:
+            timer.cancelled = True
+            self.timers -= 1
+
+    def fire(self, timer):
+        self.fired += 1
+        if timer.task is not None and not timer.task.done():
+            timer.skipped += 1
+            self.bot.LOGGER.debug(f'Timer {timer.name} is still running, skipped')
+            return
+        try:
+            result = timer.callback()
+            if asyncio.iscoroutine(result):
+                timer.task = asyncio.ensure_future(result)
+                timer.task.add_done_callback(functools.partial(self.on_done, timer))
+        except Exception as e:
+            self.bot.LOGGER.exception(f'Timer {timer.name} failed: {e}')
+
+    def on_done(self, timer, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.bot.LOGGER.error(f'Timer {timer.name} failed: {task.exception()}', exc_info=task.exception())
+
+    # Move to the next tick, cascading the slots of the upper wheels it reaches and firing the timers due
+    def advance(self):
+        self.ticks += 1
+        for level in range(self.LEVELS - 1, 0, -1):
+            if self.ticks % self.SLOTS ** level == 0:
+                slot = self.wheels[level][self.ticks // self.SLOTS ** level % self.SLOTS]
+                timers, slot[:] = list(slot), []
+                for timer in timers:
+                    if not timer.cancelled:
+                        self.insert(timer)
+        slot = self.wheels[0][self.ticks % self.SLOTS]
+        timers, slot[:] = list(slot), []
+        for timer in timers:
+            if timer.cancelled:
+                continue
+            # Timers clamped to the top wheel go back in until they are due
+            if timer.due > self.ticks:
+                self.insert(timer)
+                continue
+            self.fire(timer)
+            if timer.interval is None:
+                timer.cancelled = True
+                self.timers -= 1
+            else:
+                timer.due += timer.interval
+                self.insert(timer)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        if self.started_at is None:
+            self.started_at = loop.time()
+        while True:
+            while self.started_at + (self.ticks + 1) * self.tick <= loop.time():
+                self.advance()
+            await asyncio.sleep(self.started_at + (self.ticks + 1) * self.tick - loop.time())
+
+    def render(self):
+        return (f'# TYPE threecommas_timers gauge\nthreecommas_timers {self.timers}\n'
+                f'# TYPE threecommas_timers_fired_total counter\nthreecommas_timers_fired_total {self.fired}\n')
+
+
+class ThreeCommasBot:
+    def __init__(self, settings=None, res_dir=None, worker=None):
+        """
+        :param settings: settings to use instead of the ones in Settings.json
+        :param res_dir: directory of the pairs, state and stats files, defaults to 3CommasRes
+        :param worker: name of the worker when run by 3CommasSupervisor, suffixes the state, stats and log files
+        """
         self.PROJECT_ROOT = Path(os.path.abspath(os.path.dirname(__file__)))
+        self.RES_DIR = Path(res_dir) if res_dir else self.PROJECT_ROOT / '3CommasRes'
         self.COM_HOME_URL = 'https://3Commas.io'
         self.file_cc = str(self.PROJECT_ROOT / '__pycache__/cc.py')
-        self.file_settings = str(self.PROJECT_ROOT / '3CommasRes/Settings.json')
-        self.file_pairs = str(self.PROJECT_ROOT / '3CommasRes/Pairs.csv')
-        self.file_trades_stats = str(self.PROJECT_ROOT / '3CommasRes/SmartTradesStats.csv')
-        self.file_trades_state = str(self.PROJECT_ROOT / '3CommasRes/SmartTradesStates.csv')
-        self.settings = self.get_settings()["Settings"]
+        self.file_settings = str(self.RES_DIR / 'Settings.json')
+        self.file_pairs = str(self.RES_DIR / 'Pairs.csv')
+        self.worker = worker
+        suffix = f'-{worker}' if worker else ''
+        self.file_trades_stats = str(self.RES_DIR / f'SmartTradesStats{suffix}.bin')
+        self.file_trades_state = str(self.RES_DIR / f'SmartTradesState{suffix}.jsonl')
+        self.file_heartbeat = str(self.RES_DIR / f'Workers/{worker}.json') if worker else None
+        self.file_trades_state_csv = str(self.RES_DIR / 'SmartTradesStates.csv')
+        self.file_sync = str(self.RES_DIR / 'Sync.db')
+        self.settings = settings if settings is not None else self.get_settings()["Settings"]
         self.api_name = self.settings['APIName']
         self.api_key = self.settings['APIKey']
         self.api_secret = self.settings['APISecret']
@@ -38,15 +1779,50 @@ class ThreeCommasBot:
         self.cc_status = False
         self.positions = {}
         self.position = False
-        self.LOGGER = self.get_logger()
+        self.pair_states = {}
+        self.reentry_latencies = collections.deque(maxlen=10000)
+        self.metrics = Metrics()
+        self.executor = None
+        self.order_executor = None
+        self.scheduler = None
+        self.file_record = None
+        self.recorder = None
+        self.poller = SmartTradePoller(bot=self)
+        self.stream = SmartTradeStream(bot=self)
+        self.price_cache = PriceCache(bot=self)
+        self.market_rules = MarketRules(bot=self)
+        self.notifier = TelegramNotifier(bot=self)
+        self.journal = StateJournal(file_journal=self.file_trades_state,
+                                    compact_records=self.settings.get('StateJournalCompactRecords', 1000))
+        self.stats = StatsStore(file_stats=self.file_trades_stats,
+                                batch_size=self.settings.get('StatsBatchSize', 100))
+        self.sync_store = SyncStore(file_db=self.file_sync)
+        self.exposure = ExposureEngine(bot=self, file_db=str(self.RES_DIR / 'Margin.db'))
+        self.metrics.collectors.append(self.exposure.render)
+        self.timers = TimerWheel(bot=self, tick=self.settings.get('TimerTickSeconds', 1))
+        self.metrics.collectors.append(self.timers.render)
+        self.status_timers = {}
+        self.sync_enabled = worker is None
+        self.LOGGER = self.get_logger(file_log=f'3CommasBot{suffix}.log', level=self.settings.get('LogLevel', 'INFO'),
+                                      max_bytes=self.settings.get('LogMaxBytes', 10 * 1024 * 1024),
+                                      backup_count=self.settings.get('LogBackupCount', 5),
+                                      sample_seconds=self.settings.get('LogSampleSeconds', 60))
         # self.email_server = self.get_email_server()
 
     @staticmethod
-    def get_logger():
+    def get_logger(file_log='3CommasBot.log', level='INFO', max_bytes=10 * 1024 * 1024, backup_count=5, sample_seconds=60):
         """
-        Get logger file handler
+        Get logger, records are queued and written to the console and the JSON-lines log file by a background thread
+        :param file_log: log file, one per worker process
+        :param level: lowest level logged
+        :param max_bytes: size the log file is rotated at
+        :param backup_count: rotated log files kept
+        :param sample_seconds: a repeated status line of a pair is logged at most once in this many seconds
         :return: LOGGER
         """
+        global LOG_LISTENER
+        if LOG_LISTENER is not None:
+            LOG_LISTENER.stop()
         logging.config.dictConfig({
             "version": 1,
             "disable_existing_loggers": False,
@@ -63,31 +1839,41 @@ class ThreeCommasBot:
                         'CRITICAL': 'bold_red',
                     },
                 },
-                'simple': {
-                    'format': '[%(asctime)s,%(lineno)s] [%(message)s]',
+                'json': {
+                    '()': JsonLogFormatter,
                 },
             },
             "handlers": {
                 "console": {
                     "class": "colorlog.StreamHandler",
-                    "level": "INFO",
+                    "level": level,
                     "formatter": "colored",
                     "stream": "ext://sys.stdout"
                 },
                 "file": {
                     "class": "logging.handlers.RotatingFileHandler",
-                    "level": "INFO",
-                    "formatter": "simple",
-                    "filename": "3CommasBot.log",
-                    "maxBytes": 1 * 1024 * 1024,
-                    "backupCount": 1
+                    "level": level,
+                    "formatter": "json",
+                    "filename": file_log,
+                    "maxBytes": max_bytes,
+                    "backupCount": backup_count
                 },
             },
-            "root": {"level": "INFO",
+            "root": {"level": level,
                      "handlers": ["console", "file"]
                      }
         })
-        return logging.getLogger()
+        # Hand the console and file handlers to a listener thread, the trading path only enqueues records
+        logger = logging.getLogger()
+        handlers = logger.handlers[:]
+        for handler in handlers:
+            logger.removeHandler(handler)
+        queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+        queue_handler.addFilter(LogSampler(sample_seconds=sample_seconds))
+        logger.addHandler(queue_handler)
+        LOG_LISTENER = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        LOG_LISTENER.start()
+        return logger
 
     def get_email_server(self):
         """
@@ -102,12 +1888,9 @@ class ThreeCommasBot:
         email_server.login(sender_email, password)
         return email_server
 
+    # Queue a Telegram message, sent in the background by TelegramNotifier
     def send_telegram_msg(self, msg):
-        bot_token = self.settings['BotToken']
-        chat_id = self.settings['ChatID']
-        send_text = f'https://api.telegram.org/bot{bot_token}/sendMessage?chat_id={chat_id}&text={msg}'
-        response = requests.get(str(send_text))
-        return response.json()
+        return self.notifier.notify(msg)
 
     @staticmethod
     def enable_cmd_colors():
@@ -160,13 +1943,50 @@ class ThreeCommasBot:
         :param secret: API secret for 3commas account
         :return: Authenticated object of Py3CW
         """
+        if self.settings.get('APIURL'):
+            # Send requests to a 3Commas compatible server instead, e.g. 3CommasSimServer.py
+            sys.modules[Py3CW.__module__].API_URL = self.settings['APIURL'].rstrip('/')
         return Py3CW(key=api_key, secret=secret,
                      request_options={
                          'request_timeout': 30,
-                         'nr_of_retries': 5,
-                         'retry_status_codes': [502]
+                         # Retries are done by RequestScheduler, so that every attempt is counted in the metrics
+                         'nr_of_retries': 0,
+                         'retry_status_codes': []
                      })
 
+    # Wrap a Py3CW (or stand-in) client with instrumentation and the shared request scheduler
+    def get_client(self, client):
+        """
+        :param client: object with Py3CW's request() signature
+        :return: RequestScheduler sending requests through client
+        """
+        if self.file_record:
+            self.recorder = RecordingClient(client=client, file_record=self.file_record)
+            client = self.recorder
+        self.scheduler = RequestScheduler(client=InstrumentedClient(client=client, metrics=self.metrics),
+                                          rate=self.settings.get('RequestRate', 5),
+                                          burst=self.settings.get('RequestBurst', 20),
+                                          reserved_tokens=self.settings.get('ReservedOrderTokens', 2),
+                                          retry_status_codes=self.settings.get('RetryStatusCodes', [502]),
+                                          metrics=self.metrics)
+        self.metrics.collectors.append(self.scheduler.render)
+        return self.scheduler
+
+    # Trade with one of the AccountSets of Settings.json, sharing its request budget with the other workers using it
+    def use_account_set(self, account_set, set_workers=1):
+        """
+        :param account_set: index in AccountSets, each set may override APIKey, APISecret, AccountIDLong,
+        AccountIDShort, RequestRate and RequestBurst
+        :param set_workers: number of workers using the account set
+        """
+        account_sets = self.settings.get('AccountSets') or [{}]
+        self.settings.update(account_sets[account_set])
+        self.settings['RequestRate'] = self.settings.get('RequestRate', 5) / set_workers
+        self.settings['RequestBurst'] = max(1, self.settings.get('RequestBurst', 20) // set_workers)
+        self.api_name = self.settings['APIName']
+        self.api_key = self.settings['APIKey']
+        self.api_secret = self.settings['APISecret']
+
     # Get accounts
     def get_accounts(self):
         """
@@ -188,10 +2008,7 @@ class ThreeCommasBot:
         """
         self.LOGGER.info(f'Getting bot data: {bot_id}')
         error, bots = self.client.request(entity='bots', action='show', action_id=bot_id)
-        self.LOGGER.info(f'Bot data count: {len(bots)}')
-        # bots = json.loads(bots)
-        bots = json.dumps(bots, indent=4, sort_keys=True)
-        self.LOGGER.info(f'Bot Data: {bots}')
+        self.LOGGER.info(f'Bot data count: {len(bots)}', extra={"payload": bots})
         return bots
 
     # Get deals
@@ -200,10 +2017,7 @@ class ThreeCommasBot:
         :return: deals
         """
         error, deals = self.client.request(entity='deals', action='')
-        self.LOGGER.info(f'Deals count: {len(deals)}')
-        # deals = json.loads(deals)
-        deals = json.dumps(deals, indent=4, sort_keys=True)
-        self.LOGGER.info(f'Deals Data: {deals}')
+        self.LOGGER.info(f'Deals count: {len(deals)}', extra={"payload": deals})
         return deals
 
     # Get account stats
@@ -231,10 +2045,7 @@ class ThreeCommasBot:
         """
         error, deals_stats = self.client.request(entity='bots', action='deals_stats', action_id=bot_id,
                                                  payload={"bot_id": bot_id})
-        self.LOGGER.info(f'Total deals stats: {len(deals_stats)}')
-        # deals = json.loads(deals)
-        deals_stats = json.dumps(deals_stats, indent=4, sort_keys=True)
-        self.LOGGER.info(f'Deals Stats: {deals_stats}')
+        self.LOGGER.info(f'Total deals stats: {len(deals_stats)}', extra={"payload": deals_stats})
         return deals_stats
 
     # Update 3Commas bot's deal with new SL and TP
@@ -263,7 +2074,7 @@ class ThreeCommasBot:
         error, data = self.client.request(
             entity="accounts",
             action="currency_rates",
-            payload={"market_code": "binance", "pair": pair},
+            payload={"market_code": self.settings.get('MarketCode', 'binance'), "pair": pair},
         )
         if data:
             price = float(data["last"])
@@ -276,7 +2087,86 @@ class ThreeCommasBot:
                 self.LOGGER.info(f"Fetching 3Commas {pair} price failed")
         return None
 
-    def get_smart_trade(self, account_id, pair, pair_price, pair_qty, order_type, level=1):
+    # Get price and exchange rules of a pair: price and lot steps, minimum lot size and notional
+    def get_market_rules(self, pair):
+        """
+        currency_rates has no leverage limit, max_leverage is the one set for the pair in PairMaxLeverage
+        :return: dict of price, price_step, lot_step, min_lot, min_total and max_leverage, None if the request failed
+        """
+        self.LOGGER.info(f'Fetching 3Commas {pair} market rules')
+        error, data = self.client.request(
+            entity="accounts",
+            action="currency_rates",
+            payload={"market_code": self.settings.get('MarketCode', 'binance'), "pair": pair},
+        )
+        if data:
+            def get_float(key):
+                try:
+                    return float(data[key]) or None
+                except (KeyError, TypeError, ValueError):
+                    return None
+            return {"price": get_float("last"), "price_step": get_float("priceStep"), "lot_step": get_float("lotStep"),
+                    "min_lot": get_float("minLotSize"), "min_total": get_float("minTotal"),
+                    "max_leverage": self.settings.get('PairMaxLeverage', {}).get(pair)}
+        else:
+            if error and "msg" in error:
+                self.LOGGER.info(f'Fetching 3Commas {pair} market rules failed with error: {error["msg"]}')
+            else:
+                self.LOGGER.info(f"Fetching 3Commas {pair} market rules failed")
+        return None
+
+    @staticmethod
+    def round_step(value, step, rounding=decimal.ROUND_HALF_UP):
+        """
+        :return: value rounded to a multiple of step
+        """
+        step = decimal.Decimal(str(step))
+        return float((decimal.Decimal(str(value)) / step).quantize(decimal.Decimal(1), rounding=rounding) * step)
+
+    # Quantities of every level up to LevelCap and TP/SL prices of both legs at pair_price, within the pair rules
+    def get_level_ladder(self, pair, pair_price, rules=None):
+        """
+        :param rules: rules of the pair as returned by get_market_rules, None to round prices to 5 and quantities
+        to 3 decimals
+        :return: dict of price, leverage, quantity of every level and TP1/TP2/SL prices of the long and short legs
+        """
+        rules = rules or {}
+        price_step, lot_step = rules.get("price_step"), rules.get("lot_step")
+
+        def round_price(price):
+            return self.round_step(price, price_step) if price_step else round(price, 5)
+
+        quantities = {}
+        for level in range(1, self.settings.get('LevelCap', 7) + 1):
+            amount_usdt = self.get_level_amount(level=level)
+            if lot_step:
+                pair_qty = self.round_step(decimal.Decimal(str(amount_usdt)) / decimal.Decimal(str(pair_price)), lot_step,
+                                           rounding=decimal.ROUND_DOWN)
+                # Raise quantities below the minimum lot or notional of the exchange to the smallest accepted one
+                min_qty = max(rules.get("min_lot") or 0, (rules.get("min_total") or 0) / pair_price)
+                if pair_qty < min_qty:
+                    pair_qty = self.round_step(min_qty, lot_step, rounding=decimal.ROUND_UP)
+            else:
+                pair_qty = round(amount_usdt / pair_price, 3)
+            quantities[level] = pair_qty
+        take_profit1, take_profit2 = self.settings['TakeProfit1'] / 100, self.settings['TakeProfit2'] / 100
+        stop_loss = self.settings['TrailingStopLoss'] / 100
+        leverage = self.settings['Leverage']
+        if rules.get("max_leverage"):
+            leverage = min(leverage, rules["max_leverage"])
+        return {
+            "pair": pair, "price": pair_price, "leverage": leverage, "quantities": quantities,
+            "long": {"tp1": round_price(pair_price * (1 + take_profit1)), "tp2": round_price(pair_price * (1 + take_profit2)),
+                     "sl": round_price(pair_price * (1 - stop_loss))},
+            "short": {"tp1": round_price(pair_price * (1 - take_profit1)), "tp2": round_price(pair_price * (1 - take_profit2)),
+                      "sl": round_price(pair_price * (1 + stop_loss))},
+        }
+
+    def get_smart_trade(self, account_id, pair, pair_price, pair_qty, order_type, level=1, targets=None, leverage=None):
+        """
+        :param targets: dict of tp1, tp2 and sl prices from get_level_ladder, None to derive them from pair_price
+        :param leverage: leverage to use instead of the Leverage setting
+        """
         position_type = "buy"
         tp1 = round(pair_price + (self.settings['TakeProfit1'] / 100 * pair_price), 5)
         tp2 = round(pair_price + (self.settings['TakeProfit2'] / 100 * pair_price), 5)
@@ -286,6 +2176,8 @@ class ThreeCommasBot:
             tp1 = round(pair_price - (self.settings['TakeProfit1'] / 100 * pair_price), 5)
             tp2 = round(pair_price - (self.settings['TakeProfit2'] / 100 * pair_price), 5)
             sl = round(pair_price + (self.settings['TrailingStopLoss'] / 100 * pair_price), 5)
+        if targets is not None:
+            tp1, tp2, sl = targets["tp1"], targets["tp2"], targets["sl"]
         smart_trade = {
             "account_id": account_id,
             "instant": "false",
@@ -294,7 +2186,7 @@ class ThreeCommasBot:
             "leverage": {
                 "enabled": "true",
                 "type": "isolated",
-                "value": self.settings['Leverage']},
+                "value": leverage or self.settings['Leverage']},
             "position": {
                 "type": position_type,
                 "units": {
@@ -339,7 +2231,7 @@ class ThreeCommasBot:
             payload=smart_trade
         )
         if data:
-            self.LOGGER.info(f'SmartTrade has been placed: {json.dumps(data, indent=4)}')
+            self.LOGGER.info(f'SmartTrade has been placed: {data.get("id")}', extra={"pair": smart_trade.get("pair"), "payload": data})
             return data
         else:
             if error and "msg" in error:
@@ -348,6 +2240,182 @@ class ThreeCommasBot:
                 self.LOGGER.info(f"SmartTrade error")
         return None
 
+    # Find the SmartTrade of a placement that was answered with an error, but went through
+    def find_smart_trade(self, smart_trade, exclude=()):
+        """
+        :param smart_trade: SmartTrade data as sent to smart_trades_v2/new
+        :param exclude: IDs of SmartTrades known to be other legs
+        :return: tuple of whether the account could be listed and the matching untracked SmartTrade, or None
+        """
+        # The lookup holds up an entry, so it goes ahead of the status polls
+        smart_trades = self.get_smart_trades(account_id=smart_trade["account_id"], priority=RequestScheduler.PRIORITY_ORDER)
+        if smart_trades is None:
+            return False, None
+        known = set(self.poller.accounts) | {str(smart_trade_id) for smart_trade_id in exclude}
+        for data in smart_trades:
+            if (data.get("pair") == smart_trade["pair"] and str(data.get("id")) not in known
+                    and data.get("position", {}).get("type") == smart_trade["position"]["type"]
+                    and data.get("note", smart_trade["note"]) == smart_trade["note"]):
+                self.LOGGER.info(f'SmartTrade {data["id"]} was placed despite the error', extra={"pair": smart_trade["pair"]})
+                return True, data
+        return True, None
+
+    def get_smart_trades(self, account_id, status='active', priority=None):
+        """
+        Get all the SmartTrades of an account, page by page
+        :param account_id: account to list SmartTrades of
+        :param status: SmartTrades status filter
+        :param priority: priority class instead of the one of the endpoint
+        :return: list of SmartTrades, None if any page failed
+        """
+        try:
+            return list(self.iter_smart_trades(account_id=account_id, status=status, priority=priority))
+        except ConnectionError:
+            return None
+
+    # Fetch one page of a listing, raising ConnectionError if it failed so that a sync never skips a page
+    def get_page(self, entity, action, payload, name, priority=None, action_id=None):
+        kwargs = {"priority": priority} if priority is not None else {}
+        error, data = self.client.request(entity=entity, action=action, action_id=action_id, payload=payload, **kwargs)
+        if error:
+            if "msg" in error:
+                self.LOGGER.info(f'Fetching {name} failed with error: {error["msg"]}')
+            else:
+                self.LOGGER.info(f"Fetching {name} failed")
+            raise ConnectionError(f'Fetching {name} failed')
+        return data or []
+
+    # Iterate over the SmartTrades of an account, one page in memory at a time
+    def iter_smart_trades(self, account_id, status='active', order_by=None, per_page=100, priority=None):
+        """
+        :param order_by: e.g. updated_at to get the latest updated first
+        :return: generator of SmartTrades
+        """
+        page = 1
+        while True:
+            payload = {"account_id": account_id, "status": status, "page": page, "per_page": per_page}
+            if order_by:
+                payload.update(order_by=order_by, order_direction='desc')
+            data = self.get_page(entity='smart_trades_v2', action='', payload=payload, priority=priority,
+                                 name=f'SmartTrades of account {account_id}')
+            yield from data
+            if len(data) < per_page:
+                return
+            page += 1
+
+    # Iterate over deals, the latest updated first, one page in memory at a time
+    def iter_deals(self, per_page=100, priority=None, **filters):
+        """
+        :param filters: deals filters of 3Commas, e.g. scope, bot_id, account_id
+        :return: generator of deals
+        """
+        offset = 0
+        while True:
+            payload = dict(filters, limit=per_page, offset=offset, order='updated_at', order_direction='desc')
+            data = self.get_page(entity='deals', action='', payload=payload, priority=priority, name='deals')
+            yield from data
+            if len(data) < per_page:
+                return
+            offset += per_page
+
+    # Iterate over the DCA bots of the API key
+    def iter_bots(self, per_page=100, priority=None):
+        offset = 0
+        while True:
+            data = self.get_page(entity='bots', action='', payload={"limit": per_page, "offset": offset},
+                                 priority=priority, name='bots')
+            yield from data
+            if len(data) < per_page:
+                return
+            offset += per_page
+
+    # Iterate over the deals stats of bots
+    def iter_bot_stats(self, bot_ids, priority=None):
+        """
+        :return: generator of (bot_id, deals stats)
+        """
+        for bot_id in bot_ids:
+            yield bot_id, self.get_page(entity='bots', action='deals_stats', action_id=bot_id, payload={"bot_id": bot_id},
+                                        priority=priority, name=f'deals stats of bot {bot_id}')
+
+    # Store records until the first one older than the cursor, then move the cursor to the latest one stored
+    def sync_records(self, cursor_name, records, put, batch_size=100):
+        """
+        :param records: iterator of records, the latest updated first
+        :param put: function storing a batch of records
+        :return: number of records stored
+        """
+        cursor = self.sync_store.get_cursor(cursor_name)
+        latest = cursor
+        count = 0
+        batch = []
+        for record in records:
+            updated_at = SyncStore.get_updated_at(record)
+            if cursor and updated_at and updated_at < cursor:
+                break
+            batch.append(record)
+            latest = max(latest or '', updated_at or '')
+            if len(batch) >= batch_size:
+                put(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            put(batch)
+            count += len(batch)
+        if latest:
+            self.sync_store.set_cursor(cursor_name, latest)
+        return count
+
+    # Copy the deals, SmartTrades and bot stats updated since the last sync into the local SyncStore
+    def sync(self):
+        """
+        :return: dict of the number of records synced
+        """
+        priority = RequestScheduler.PRIORITY_READ if isinstance(self.client, RequestScheduler) else None
+        synced = {}
+        for account_id in dict.fromkeys([self.settings['AccountIDLong'], self.settings['AccountIDShort']]):
+            synced[f'SmartTrades {account_id}'] = self.sync_records(
+                cursor_name=f'smart_trades:{account_id}', put=self.sync_store.put_smart_trades,
+                records=self.iter_smart_trades(account_id=account_id, status='all', order_by='updated_at', priority=priority))
+        bot_ids = set()
+
+        def put_deals(deals):
+            self.sync_store.put_deals(deals)
+            bot_ids.update(deal["bot_id"] for deal in deals if deal.get("bot_id"))
+
+        # Deals belong to the API key, account sets with other keys keep their own cursor
+        key_id = hashlib.sha256(self.api_key.encode()).hexdigest()[:12]
+        synced["Deals"] = self.sync_records(cursor_name=f'deals:{key_id}', records=self.iter_deals(priority=priority),
+                                            put=put_deals)
+        # Stats only change with deals, refresh them for the bots with updated deals and the ones never synced
+        bot_ids.update({bot["id"] for bot in self.iter_bots(priority=priority)} - self.sync_store.get_bot_ids())
+        synced["BotStats"] = 0
+        for bot_id, stats in self.iter_bot_stats(bot_ids=sorted(bot_ids), priority=priority):
+            self.sync_store.put_bot_stats(bot_id, stats)
+            synced["BotStats"] += 1
+        return synced
+
+    # Cancel a SmartTrade, closing it by market if it already has a position
+    def cancel_smart_trade(self, smart_trade_id):
+        """
+        :param smart_trade_id: SmartTrade to cancel
+        :return: True if the SmartTrade was cancelled or closed
+        """
+        self.LOGGER.info(f'Cancelling SmartTrade {smart_trade_id}')
+        for action in ('cancel', 'close_by_market'):
+            error, data = self.client.request(
+                entity='smart_trades_v2',
+                action=action,
+                action_id=str(smart_trade_id),
+            )
+            if data:
+                return True
+            if error and "msg" in error:
+                self.LOGGER.info(f'SmartTrade {smart_trade_id} {action} failed with error: {error["msg"]}')
+            else:
+                self.LOGGER.info(f"SmartTrade {smart_trade_id} {action} failed")
+        return False
+
     def get_smart_trade_by_id(self, smart_trade_id):
         # Get SmartTrade history
         self.LOGGER.info(f'Fetching SmartTrade {smart_trade_id} history')
@@ -365,162 +2433,470 @@ class ThreeCommasBot:
                 self.LOGGER.info(f"Fetching SmartTrade {smart_trade_id} failed")
         return None
 
-    # Main Strategy
-    def strategy(self, pair):
-        level = 1
-        tp_count = 0
-        tsl_count = 0
-        trade_count = 2
-        pnl = 0
-        pnls = [0] * 8
-        start_time = datetime.now().strftime("%H:%M:%S")
+    # Get USDT amount of a martingale level
+    def get_level_amount(self, level):
+        """
+        :param level: martingale level, starting at 1
+        :return: USDT amount to trade at the level, doubled on every level
+        """
+        return round(self.settings['AmountUSDT'] * 2 ** (level - 1), 2)
+
+    @staticmethod
+    def get_smart_trade_outcome(smart_trade_history):
+        """
+        Classifies a SmartTrade from its status
+        :param smart_trade_history: SmartTrade data as returned by smart_trades_v2/get_by_id
+        :return: 'open', 'tp', 'tsl', 'failed' or 'cancelled', a cancelled or closed by market SmartTrade hit neither
+        its TP nor its SL
+        """
+        status = smart_trade_history["status"]
+        status_text = f'{status.get("type", "")} {status.get("basic_type", "")} {status.get("title", "")}'.lower()
+        if 'failed' in status_text:
+            return 'failed'
+        if any(word in status_text for word in ('progress', 'pending', 'waiting', 'created', 'new')):
+            return 'open'
+        if 'stop_loss' in status_text or 'stop loss' in status_text:
+            return 'tsl'
+        if any(word in status_text for word in ('cancelled', 'panic_sold', 'closed by market')):
+            return 'cancelled'
+        if any(word in status_text for word in ('completed', 'finished', 'closed')):
+            return 'tp' if float(smart_trade_history["profit"]["usd"]) > 0 else 'tsl'
+        return 'open'
+
+    # Run a blocking Py3CW/requests call without blocking the other pairs
+    async def run_blocking(self, func, *args, **kwargs):
+        """
+        :param func: blocking callable, e.g. self.get_pair_price
+        :return: result of func(*args, **kwargs), computed on the bot's thread pool
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    # Run an order placement call on its own thread pool, so it never queues behind throttled polls
+    async def run_order(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.order_executor, functools.partial(func, *args, **kwargs))
+
+    # State or stats files of all the workers, so that pairs moved between workers keep their state
+    def get_worker_files(self, pattern):
+        return sorted(str(file_worker) for file_worker in self.RES_DIR.glob(pattern))
+
+    # Load the state journal, importing SmartTradesStates.csv of older versions on first run
+    def load_trades_state(self):
+        states = self.journal.load(files_merge=self.get_worker_files('SmartTradesState*.jsonl'))
+        if not states and os.path.isfile(self.file_trades_state_csv):
+            self.LOGGER.info(f'Importing SmartTradesState from {self.file_trades_state_csv}')
+            with open(self.file_trades_state_csv, newline='') as f:
+                for trade_state in csv.DictReader(f):
+                    self.journal.append(trade_state)
+        self.LOGGER.info(f'SmartTradesState loaded: {len(self.journal.states)} pairs')
+
+    # Load persisted state of a pair from the state journal
+    def load_pair_state(self, pair):
+        """
+        :param pair: pair to load state of
+        :return: PairState, restored from the journal when the pair has one
+        """
+        state = PairState(pair=pair, amount_usdt=self.get_level_amount(level=1), level_cap=self.settings.get('LevelCap', 7))
+        trade_state = self.journal.get(pair)
+        if trade_state is None:
+            return state
+        if str(trade_state.get('AccountIDLong', self.settings['AccountIDLong'])) != str(self.settings['AccountIDLong']):
+            self.LOGGER.info(f'Pair: {pair}, SmartTrades were placed on account {trade_state["AccountIDLong"]}, starting from base order', extra={"pair": pair})
+            return state
+        state.start_time = trade_state['StartTime']
+        state.smart_trade_id_l = str(trade_state['SmartTradeLong']) if trade_state['SmartTradeLong'] else None
+        state.smart_trade_id_s = str(trade_state['SmartTradeShort']) if trade_state['SmartTradeShort'] else None
+        state.pnl = float(trade_state['PnL'])
+        state.level = min(int(trade_state['Level']), len(state.pnls) - 1)
+        state.trade_count = int(trade_state['TradeCount'])
+        state.tp_count = int(trade_state['TPCount'])
+        state.tsl_count = int(trade_state['TSLCount'])
+        state.pnls[state.level] = state.pnl
+        state.amount_usdt = self.get_level_amount(level=state.level)
+        return state
+
+    # Append state of a pair to the state journal
+    async def save_pair_state(self, state):
+        await self.run_blocking(self.journal.append, dict(state.to_dict(), AccountIDLong=self.settings['AccountIDLong'],
+                                                          AccountIDShort=self.settings['AccountIDShort']))
+
+    # Record a TP/TSL event of a pair in the stats store
+    def save_trade_stats(self, state, event):
+        self.stats.record(state=state, event=event)
+        trade_stats = {"TimeStamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "Pair": state.pair,
+                       "Trade count": state.trade_count, "Level": state.level, "TP count": state.tp_count,
+                       "TSL count": state.tsl_count}
+        return trade_stats
+
+    # Flush buffered stats to disk
+    async def flush_stats(self):
+        await self.run_blocking(self.stats.flush)
+
+    # Print TP/TSL summaries of the pairs in the stats store
+    def report_stats(self, pair=None, hours=None):
+        """
+        :param pair: pair to report, all pairs if None
+        :param hours: look back window, all time if None
+        """
+        self.stats.load(files=self.get_worker_files('SmartTradesStats*.bin'))
+        pairs = [pair] if pair else sorted(self.stats.totals)
+        print(f'{"Pair":<16}{"Trades":>8}{"MaxLevel":>10}{"TP":>6}{"TSL":>6}{"TP/TSL":>8}{"PnL":>12}')
+        for pair in pairs:
+            summary = self.stats.get_summary(pair=pair, hours=hours)
+            ratio = round(summary["TP"] / summary["TSL"], 2) if summary["TSL"] else '-'
+            print(f'{pair:<16}{summary["Trades"]:>8}{summary["MaxLevel"]:>10}{summary["TP"]:>6}{summary["TSL"]:>6}'
+                  f'{ratio:>8}{round(summary["PnL"], 2):>12}')
+
+    # Place both legs of a pair entry as one operation
+    async def place_pair_entry(self, pair, smart_trade_l, smart_trade_s):
+        """
+        Submits the LONG and SHORT SmartTrades concurrently and retries a failed leg up to EntryLegRetries times. A leg
+        answered with an error may still have been opened, so it is looked up before it is placed again.
+        If one leg still fails, the placed leg is cancelled (or closed by market), so the pair is never left half-hedged.
+        :return: dict of ok, long and short SmartTrade responses, ok is True only if both legs were placed
+        """
+        legs = {"long": smart_trade_l, "short": smart_trade_s}
+        responses = {"long": None, "short": None}
+        unchecked = []
+        for attempt in range(self.settings.get('EntryLegRetries', 2) + 1):
+            unchecked = await self.find_legs(legs=legs, responses=responses, sides=unchecked)
+            failed = [side for side, response in responses.items() if response is None and side not in unchecked]
+            if not failed:
+                if unchecked:
+                    continue
+                break
+            if attempt:
+                self.LOGGER.info(f'Pair: {pair}, Retrying {" & ".join(failed).upper()} SmartTrade, attempt {attempt}', extra={"pair": pair})
+                self.metrics.observe_retry(entity='smart_trades_v2', action='new')
+            results = await asyncio.gather(*[self.run_order(self.place_smart_trade, smart_trade=legs[side])
+                                             for side in failed])
+            responses.update(zip(failed, results))
+            unchecked += [side for side in failed if responses[side] is None]
+        unchecked = await self.find_legs(legs=legs, responses=responses, sides=unchecked)
+        for side in unchecked:
+            self.send_telegram_msg(msg=f'TimeStamp: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, Pair: {pair}, '
+                                       f'{side.upper()} SmartTrade may have been placed, check account {legs[side]["account_id"]}')
+        placed = [side for side, response in responses.items() if response is not None]
+        if len(placed) == 2:
+            return {"ok": True, **responses}
+        self.LOGGER.info(f'Pair: {pair}, Placing SmartTrades failed, Long: {responses["long"] is not None} Short: {responses["short"] is not None}', extra={"pair": pair})
+        for side in placed:
+            smart_trade_id = responses[side]["id"]
+            cancelled = await self.run_order(self.cancel_smart_trade, smart_trade_id=smart_trade_id)
+            if not cancelled:
+                self.send_telegram_msg(msg=f'TimeStamp: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, Pair: {pair}, '
+                                           f'{side.upper()} SmartTrade {smart_trade_id} is left open without its hedge')
+        return {"ok": False, **responses}
+
+    # Look up the legs answered with an error, as they may have been opened anyway
+    async def find_legs(self, legs, responses, sides):
+        """
+        :param sides: sides of legs whose placement failed, responses is updated with the ones found
+        :return: sides that could not be looked up
+        """
+        exclude = [response["id"] for response in responses.values() if response]
+        found = await asyncio.gather(*[self.run_blocking(self.find_smart_trade, smart_trade=legs[side], exclude=exclude)
+                                       for side in sides])
+        responses.update((side, smart_trade) for side, (_, smart_trade) in zip(sides, found) if smart_trade)
+        return [side for side, (checked, _) in zip(sides, found) if not checked]
+
+    # Place LONG and SHORT SmartTrades of the current level of a pair
+    async def place_level(self, state):
+        """
+        :param state: PairState of the pair, updated with the new SmartTrade IDs
+        :return: True if both SmartTrades were placed
+        """
+        pair = state.pair
         order_type = self.settings['OrderType']
-        amount_usdt = self.settings['AmountUSDT']
+        pair_price = await self.price_cache.get(pair=pair)
+        if pair_price is None:
+            return False
+        ladder = await self.market_rules.get_ladder(pair=pair, price=pair_price)
+        pair_qty = ladder["quantities"].get(state.level) or round(state.amount_usdt / pair_price, 3)
+        self.LOGGER.info(f'Pair: {pair}, Quantity to trade: {pair_qty} {pair}', extra={"pair": pair, "level": state.level})
+        self.LOGGER.info(f'Pair: {pair}, Placing SmartTrades with {state.amount_usdt}USD, sides: LONG & SHORT', extra={"pair": pair, "level": state.level})
+        smart_trade_l = self.get_smart_trade(account_id=self.settings['AccountIDLong'], pair=pair, pair_price=ladder["price"], pair_qty=pair_qty, order_type=order_type, level=state.level, targets=ladder["long"], leverage=ladder["leverage"])
+        smart_trade_s = self.get_smart_trade(account_id=self.settings['AccountIDShort'], pair=pair, pair_price=ladder["price"], pair_qty=pair_qty, order_type=order_type, level=state.level, targets=ladder["short"], leverage=ladder["leverage"])
+        # Hold the margin of the level while it is placed, so concurrent pairs can not spend it twice
+        legs = {"long": self.settings['AccountIDLong'], "short": self.settings['AccountIDShort']}
+        notional = pair_qty * ladder["price"]
+        short_accounts = self.exposure.reserve(pair=pair, notional=notional, leverage=ladder["leverage"], legs=legs)
+        if short_accounts:
+            self.LOGGER.info(f'Pair: {pair}, Not enough margin on account {", ".join(map(str, short_accounts))} for {round(notional, 2)}USDT at level {state.level}, waiting', extra={"pair": pair, "level": state.level})
+            return False
+        entry = await self.place_pair_entry(pair=pair, smart_trade_l=smart_trade_l, smart_trade_s=smart_trade_s)
+        if not entry["ok"]:
+            for side, account_id in legs.items():
+                self.exposure.remove_position(account_id, pair, side)
+            self.metrics.observe_retry(entity='smart_trades_v2', action='new')
+            return False
+        smart_trade_response_l, smart_trade_response_s = entry["long"], entry["short"]
+        margin = notional / ladder["leverage"]
+        self.exposure.set_position(legs["long"], pair, 'long', str(smart_trade_response_l["id"]), notional, margin)
+        self.exposure.set_position(legs["short"], pair, 'short', str(smart_trade_response_s["id"]), notional, margin)
+        for smart_trade_id in (state.smart_trade_id_l, state.smart_trade_id_s):
+            if smart_trade_id is not None:
+                self.poller.forget(smart_trade_id)
+        state.smart_trade_id_l = str(smart_trade_response_l["id"])
+        state.smart_trade_id_s = str(smart_trade_response_s["id"])
+        state.pnls[state.level] = 0
+        await self.save_pair_state(state)
+        return True
+
+    # Place the next level of a pair until both legs are accepted
+    async def reenter(self, state, detected_at):
+        """
+        :param state: PairState of the pair
+        :param detected_at: monotonic() time the TP/TSL was detected, to measure re-entry latency
+        """
+        while not await self.place_level(state):
+            await asyncio.sleep(self.settings['CheckInterval'])
+        self.reentry_latencies.append(monotonic() - detected_at)
+
+    # Main Strategy
+    async def strategy(self, pair):
+        state = self.load_pair_state(pair=pair)
+        self.pair_states[pair] = state
+        # Send a Telegram alert every 24Hrs, at the time of day the pair started
+        self.timers.cancel(self.status_timers.get(pair))
+        self.status_timers[pair] = self.timers.every(interval=24 * 3600, delay=self.get_seconds_until(state.start_time), name=f'status {pair}',
+                                                     callback=lambda: self.send_telegram_msg(msg=f'TimeStamp: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, Pair: {pair} Bot Status: Working ...'))
         check_interval = self.settings['CheckInterval']
-        if os.path.isfile(self.file_trades_state):
-            trades_state = pd.read_csv(self.file_trades_state, index_col=None)
-            time_stamp = trades_state.iloc[0]['TimeStamp']
-            start_time = trades_state.iloc[0]['StartTime']
-            pair = trades_state.iloc[0]['Pair']
-            smart_trade_id_l = str(trades_state.iloc[0]['SmartTradeLong'])
-            smart_trade_id_s = str(trades_state.iloc[0]['SmartTradeShort'])
-            pnl = float(trades_state.iloc[0]['PnL'])
-            level = int(trades_state.iloc[0]['Level'])
-            trade_count = int(trades_state.iloc[0]['TradeCount'])
-            tp_count = int(trades_state.iloc[0]['TPCount'])
-            tsl_count = int(trades_state.iloc[0]['TSLCount'])
-            pnls[level] = pnl
-        else:
-            pair_price = self.get_pair_price(pair=pair)
-            pair_qty = round(amount_usdt / pair_price, 3)
-            self.LOGGER.info(f'Pair: {pair}, Quantity to trade: {pair_qty} {pair}')
-            self.LOGGER.info(f'Pair: {pair}, Placing SmartTrades with {amount_usdt}USD, sides: LONG & SHORT')
-            smart_trade_l = self.get_smart_trade(account_id=self.settings['AccountIDLong'], pair=pair, pair_price=pair_price, pair_qty=pair_qty, order_type=order_type, level=level)
-            smart_trade_s = self.get_smart_trade(account_id=self.settings['AccountIDShort'], pair=pair, pair_price=pair_price, pair_qty=pair_qty, order_type=order_type, level=level)
+        level_cap = self.settings.get('LevelCap', 7)
+        while state.smart_trade_id_l is None and not await self.place_level(state):
+            await asyncio.sleep(check_interval)
 
         while True:
-            self.LOGGER.info(f'Pair: {pair}, Checking SmartTrades status in {check_interval} seconds')
-            sleep(check_interval)
-            smart_trade_history_l = self.get_smart_trade_by_id(smart_trade_id=smart_trade_id_l)
-            smart_trade_history_s = self.get_smart_trade_by_id(smart_trade_id=smart_trade_id_s)
-            if smart_trade_history_l is None or smart_trade_history_s is None:
-                continue
+            smart_trade_history_l, smart_trade_history_s = await asyncio.gather(
+                self.poller.get(smart_trade_id=state.smart_trade_id_l, account_id=self.settings['AccountIDLong'], pair=pair),
+                self.poller.get(smart_trade_id=state.smart_trade_id_s, account_id=self.settings['AccountIDShort'], pair=pair))
             smart_trade_status_l = str(smart_trade_history_l["status"]["title"])
             smart_trade_tp_l = float(smart_trade_history_l["profit"]["usd"])
             smart_trade_status_s = str(smart_trade_history_s["status"]["title"])
             smart_trade_tp_s = float(smart_trade_history_s["profit"]["usd"])
-            pnls[level] = smart_trade_tp_l + smart_trade_tp_s
-            pnl = sum(pnls)
-            self.LOGGER.info(f'Pair: {pair} | SmartTrade status: Long: {smart_trade_status_l} Short: {smart_trade_status_s} | TP Long: {smart_trade_tp_l} TP Short: {smart_trade_tp_s} | PnL: {pnl} | Trade count: {trade_count} | Level: {level} | TP count: {tp_count} TSL count: {tsl_count}')
-            if 'failed' in smart_trade_status_l.lower() or 'failed' in smart_trade_status_s.lower():
-                self.send_telegram_msg(msg=f'TimeStamp: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, Pair: {pair}, SmartTrade Status: Failed')
-            # If hits TP, place order same as the previous position
-            if tp_count == 1:
-                self.LOGGER.info(f'Pair: {pair} | SmartTrades hit TP: {smart_trade_history_l["profit"]["usd"]} | {smart_trade_history_s["profit"]["usd"]} | PnL: {pnl} | Placing SmartTrades with {amount_usdt}USDT')
-                self.LOGGER.info(f'Pair: {pair} | SmartTrade status: Long: {smart_trade_status_l} Short: {smart_trade_status_s} | TP Long: {smart_trade_tp_l} TP Short: {smart_trade_tp_s} | PnL: {pnl} | Trade count: {trade_count} | Level: {level} | TP count: {tp_count} TSL count: {tsl_count}')
-                trade_state = {"TimeStamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "StartTime": start_time,
-                               "Pair": pair, "SmartTradeLong": smart_trade_id_l, "SmartTradeShort": smart_trade_id_s,
-                               "PnL": pnl, "Level": level, "TradeCount": trade_count, "TPCount": tp_count,
-                               "TSLCount": tsl_count}
-                state_df = pd.DataFrame([trade_state])
-                state_df.to_csv(self.file_trades_state, index=False)
-                self.LOGGER.info(f'SmartTradesState updated: {state_df.head()}')
-                trade_stats = {"TimeStamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "Pair": pair, "Trade count": trade_count, "Level": level, "TP count": tp_count, "TSL count": tsl_count}
+            self.exposure.update(account_id=self.settings['AccountIDLong'], pair=pair, side='long', smart_trade=smart_trade_history_l)
+            self.exposure.update(account_id=self.settings['AccountIDShort'], pair=pair, side='short', smart_trade=smart_trade_history_s)
+            state.ticks += 1
+            state.pnls[state.level] = smart_trade_tp_l + smart_trade_tp_s
+            state.pnl = sum(state.pnls)
+            # Formatted only if the sampler keeps it, repeats of an unchanged status are dropped
+            self.LOGGER.info('Pair: %s | SmartTrade status: Long: %s Short: %s | TP Long: %s TP Short: %s | PnL: %s | Trade count: %s | Level: %s | TP count: %s TSL count: %s',
+                             pair, smart_trade_status_l, smart_trade_status_s, smart_trade_tp_l, smart_trade_tp_s, state.pnl, state.trade_count, state.level, state.tp_count, state.tsl_count,
+                             extra={"pair": pair, "level": state.level, "sample_key": (smart_trade_status_l, smart_trade_status_s, state.level)})
+            detected_at = monotonic()
+            outcome_l = self.get_smart_trade_outcome(smart_trade_history_l)
+            outcome_s = self.get_smart_trade_outcome(smart_trade_history_s)
+            legs = {"long": (state.smart_trade_id_l, outcome_l), "short": (state.smart_trade_id_s, outcome_s)}
+            failed_ids = tuple(smart_trade_id for smart_trade_id, outcome in legs.values() if outcome == 'failed')
+            # Alert once per failed leg, not on every check while it stays failed
+            if failed_ids and failed_ids != state.failed_ids:
+                state.failed_ids = failed_ids
+                failed_sides = " & ".join(side.upper() for side, (_, outcome) in legs.items() if outcome == 'failed')
+                self.LOGGER.info(f'Pair: {pair}, {failed_sides} SmartTrade failed, closing the other leg and placing level {state.level} again', extra={"pair": pair, "level": state.level})
+                self.send_telegram_msg(msg=f'TimeStamp: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, Pair: {pair}, {failed_sides} SmartTrade Status: Failed')
+            # One leg failed while the other is open, close the open leg and place the same level again
+            if failed_ids and 'open' in (outcome_l, outcome_s):
+                closed = True
+                for side, smart_trade_history in (('long', smart_trade_history_l), ('short', smart_trade_history_s)):
+                    smart_trade_id, outcome = legs[side]
+                    if outcome != 'open':
+                        continue
+                    if not await self.run_order(self.cancel_smart_trade, smart_trade_id=smart_trade_id):
+                        closed = False
+                        continue
+                    # Realize the PnL the leg closed with before the margin of the next level is reserved
+                    smart_trade_history = await self.run_blocking(self.get_smart_trade_by_id, smart_trade_id=smart_trade_id) or smart_trade_history
+                    self.exposure.close(account_id=self.settings['AccountIDLong' if side == 'long' else 'AccountIDShort'],
+                                        pair=pair, side=side, smart_trade=smart_trade_history)
+                # An open leg that could not be closed is tried again on the next check
+                if closed:
+                    await self.reenter(state, detected_at=detected_at)
+            # Wait until both sides are closed
+            elif 'open' in (outcome_l, outcome_s):
+                pass
+            # If hits TP, place order same as the base position
+            elif 'tp' in (outcome_l, outcome_s):
+                state.tp_count += 1
+                self.LOGGER.info(f'Pair: {pair} | SmartTrades hit TP: {smart_trade_tp_l} | {smart_trade_tp_s} | PnL: {state.pnl} | Placing SmartTrades with {self.get_level_amount(level=1)}USDT', extra={"pair": pair, "level": state.level})
+                trade_stats = self.save_trade_stats(state, event=StatsStore.EVENT_TP)
                 self.send_telegram_msg(msg=json.dumps(trade_stats, indent=4))
-                stats_df = pd.DataFrame([trade_stats])
-                if not os.path.isfile(self.file_trades_stats):
-                    stats_df.to_csv(self.file_trades_stats, index=False)
-                else:  # else if exists so append without writing the header
-                    stats_df.to_csv(self.file_trades_stats, mode='a', header=False, index=False)
-                level = 1
-                pnls = [0] * 8
-                pnl = 0
-                pair_price = self.get_pair_price(pair=pair)
-                amount_usdt = self.settings['AmountUSDT']
-                pair_qty = round(amount_usdt / pair_price, 3)
-
-                smart_trade_id_l = smart_trade_response_l["id"]
-                smart_trade_id_s = smart_trade_response_s["id"]
-                trade_count += 2
+                state.reset(amount_usdt=self.get_level_amount(level=1))
+                state.trade_count += 2
+                await self.reenter(state, detected_at=detected_at)
             # If hits TSL, place order with 2x the previous position
-            elif "" == "":
-                # If level reaches 7, start over from the base order
-                self.LOGGER.info(f'Pair: {pair} | SmartTrade status: Long: {smart_trade_status_l} Short: {smart_trade_status_s} | TP Long: {smart_trade_tp_l} TP Short: {smart_trade_tp_s} | PnL: {pnl} | Trade count: {trade_count} | Level: {level} | TP count: {tp_count} TSL count: {tsl_count}')
-                if level == 7:
-                    tsl_count += 1
-                    pair_price = self.get_pair_price(pair=pair)
-                    amount_usdt = self.settings['AmountUSDT']
-                    pair_qty = round(amount_usdt / pair_price, 3)
-                    self.LOGGER.info(f'Pair: {pair}, Level reached 7, starting again from base order')
-                    self.LOGGER.info(f'Pair: {pair}, SmartTrades hit TSL: {float(smart_trade_history_l["profit"]["usd"])} {float(smart_trade_history_s["profit"]["usd"])} | PnL: {pnl} | Placing SmartTrades with {amount_usdt}USDT')
-
-                    smart_trade_id_l = smart_trade_response_l["id"]
-                    smart_trade_id_s = smart_trade_response_s["id"]
-                    trade_count += 2
-                    trade_state = {"TimeStamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "StartTime": start_time,
-                                   "Pair": pair, "SmartTradeLong": smart_trade_id_l,
-                                   "SmartTradeShort": smart_trade_id_s, "PnL": pnl, "Level": level,
-                                   "TradeCount": trade_count, "TPCount": tp_count, "TSLCount": tsl_count}
-                    state_df = pd.DataFrame([trade_state])
-                    state_df.to_csv(self.file_trades_state, index=False)
-                    self.LOGGER.info(f'SmartTradesState updated: {state_df.head()}')
-                    trade_stats = {"TimeStamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "Pair": pair, "Trade count": trade_count, "Level": level, "TP count": tp_count, "TSL count": tsl_count}
+            elif 'tsl' in (outcome_l, outcome_s):
+                state.tsl_count += 1
+                trade_stats = self.save_trade_stats(state, event=StatsStore.EVENT_TSL)
+                # If level reaches LevelCap, start over from the base order
+                if state.level == level_cap:
+                    self.LOGGER.info(f'Pair: {pair}, Level reached {level_cap}, starting again from base order', extra={"pair": pair, "level": state.level})
                     self.send_telegram_msg(msg=json.dumps(trade_stats, indent=4))
-                    stats_df = pd.DataFrame([trade_stats])
-                    if not os.path.isfile(self.file_trades_stats):
-                        stats_df.to_csv(self.file_trades_stats, index=False)
-                    else:  # else if exists so append without writing the header
-                        stats_df.to_csv(self.file_trades_stats, mode='a', header=False, index=False)
-                    level = 1
-                    pnls = [0] * 8
-                    pnl = 0
+                    state.reset(amount_usdt=self.get_level_amount(level=1))
                 else:
-                    pair_price = self.get_pair_price(pair=pair)
-                    amount_usdt = round(amount_usdt * 2, 2)
-                    pair_qty = round(amount_usdt / pair_price, 3)
-                    level += 1
-                    self.LOGGER.info(f'Pair: {pair}, SmartTrades hit TSL: {float(smart_trade_history_l["profit"]["usd"])} {float(smart_trade_history_s["profit"]["usd"])} | PnL: {pnl} | Placing SmartTrades with {amount_usdt}USDT')
-                    trade_count += 2
-                    trade_state = {"TimeStamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "StartTime": start_time,
-                                   "Pair": pair, "SmartTradeLong": smart_trade_id_l,
-                                   "SmartTradeShort": smart_trade_id_s, "PnL": pnl, "Level": level,
-                                   "TradeCount": trade_count, "TPCount": tp_count, "TSLCount": tsl_count}
-                    state_df = pd.DataFrame([trade_state])
-                    state_df.to_csv(self.file_trades_state, index=False)
-                    self.LOGGER.info(f'SmartTradesState updated: {state_df.head()}')
-                    trade_stats = {"TimeStamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "Pair": pair, "Trade count": trade_count, "Level": level, "TP count": tp_count, "TSL count": tsl_count}
-                    stats_df = pd.DataFrame([trade_stats])
-                    if not os.path.isfile(self.file_trades_stats):
-                        stats_df.to_csv(self.file_trades_stats, index=False)
-                    else:  # else if exists so append without writing the header
-                        stats_df.to_csv(self.file_trades_stats, mode='a', header=False, index=False)
-            # If time laps 24Hrs, send Telegram alert
-
-            time_laps = datetime.now().strftime("%H:%M:%S")
-            if start_time == time_laps:
-                self.send_telegram_msg(msg=f'TimeStamp: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, Pair: {pair} Bot Status: Working ...')
-
-    def main(self):
+                    state.level += 1
+                    state.amount_usdt = self.get_level_amount(level=state.level)
+                self.LOGGER.info(f'Pair: {pair}, SmartTrades hit TSL: {smart_trade_tp_l} {smart_trade_tp_s} | PnL: {state.pnl} | Placing SmartTrades with {state.amount_usdt}USDT', extra={"pair": pair, "level": state.level})
+                state.trade_count += 2
+                await self.reenter(state, detected_at=detected_at)
+            # Both sides failed or were cancelled, place the same level again without counting a TP or TSL
+            else:
+                await self.reenter(state, detected_at=detected_at)
+
+    # Seconds until the next time of day of a "%H:%M:%S" time
+    @staticmethod
+    def get_seconds_until(time_of_day):
+        now = datetime.now()
+        next_time = datetime.combine(now.date(), datetime.strptime(time_of_day, "%H:%M:%S").time())
+        if next_time <= now:
+            next_time += timedelta(days=1)
+        return (next_time - now).total_seconds()
+
+    # Sync deals, SmartTrades and bot stats into the SyncStore
+    async def sync_data(self):
+        try:
+            synced = await self.run_blocking(self.sync)
+            self.LOGGER.info(f'Synced: {synced}')
+        except Exception as e:
+            self.LOGGER.info(f'Sync failed with error: {e}')
+
+    # Print SmartTrades and deals per pair from the SyncStore
+    def report_sync(self, hours=None):
+        """
+        :param hours: look back window of the last update, all time if None
+        """
+        since = (datetime.utcnow() - timedelta(hours=hours)).isoformat() if hours else None
+        for table, title in (('smart_trades', 'SmartTrades'), ('deals', 'Deals')):
+            print(f'{title:<16}{"Count":>8}{"Open":>8}{"PnL":>12}')
+            for pair, count, open_count, pnl in self.sync_store.get_pair_summary(table=table, since=since):
+                print(f'{pair or "-":<16}{count:>8}{open_count or 0:>8}{round(pnl or 0, 2):>12}')
+
+    # Log a metrics summary
+    def log_metrics(self):
+        for line in self.metrics.get_summary():
+            self.LOGGER.info(f'Metrics: {line}')
+        if self.scheduler is not None:
+            self.LOGGER.info(f'Metrics: Request budget: {self.scheduler.get_budget()}')
+        for line in self.exposure.get_summary():
+            self.LOGGER.info(f'Metrics: {line}')
+
+    # Tell 3CommasSupervisor the worker is alive, written from the event loop so a stalled loop shows
+    def write_heartbeat(self):
+        heartbeat = {"Worker": self.worker, "PID": os.getpid(), "TimeStamp": time(), "Pairs": len(self.pair_states),
+                     "Ticks": sum(state.ticks for state in self.pair_states.values()),
+                     "Reentries": len(self.reentry_latencies)}
+        with open(f'{self.file_heartbeat}.tmp', 'w') as f:
+            json.dump(heartbeat, f)
+        os.replace(f'{self.file_heartbeat}.tmp', self.file_heartbeat)
+
+    # Run strategy of a pair, restarting it from its saved state if it crashes
+    async def run_pair(self, pair):
+        while True:
+            try:
+                await self.strategy(pair=pair)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.LOGGER.exception(f'Pair: {pair}, Strategy crashed: {e}, restarting in {self.settings["CheckInterval"]} seconds', extra={"pair": pair})
+                await asyncio.sleep(self.settings['CheckInterval'])
+
+    # Run strategies of all the pairs concurrently as asyncio tasks
+    async def run_pairs(self, pairs_list):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.settings.get('MaxWorkers', 32))
+        self.order_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.settings.get('MaxOrderWorkers', 8))
+        # Pairs that do not fit a stats record are not traded rather than recorded under a cut name
+        for pair in [pair for pair in pairs_list if len(pair.encode()) > StatsStore.PAIR_BYTES]:
+            self.LOGGER.error(f'Pair: {pair} is longer than {StatsStore.PAIR_BYTES} bytes, skipped', extra={"pair": pair})
+        pairs_list = [pair for pair in pairs_list if len(pair.encode()) <= StatsStore.PAIR_BYTES]
+        self.load_trades_state()
+        if self.recorder is not None:
+            self.recorder.start(pairs=pairs_list, states=self.journal.states, settings=self.settings)
+            self.timers.every(self.settings.get('RecordFlushSeconds', 5), self.recorder.flush, name='record')
+        await self.run_blocking(self.stats.load, files=self.get_worker_files('SmartTradesStats*.bin'))
+        if not self.exposure.get_snapshot():
+            await self.exposure.refresh()
+        # Periodic work of the bot runs on the timer wheel
+        self.timers.every(self.exposure.refresh_seconds, self.exposure.refresh, name='balances')
+        self.timers.every(self.market_rules.ttl, self.market_rules.refresh, name='market rules')
+        self.timers.every(self.settings.get('StatsFlushSeconds', 60), self.flush_stats)
+        self.timers.every(self.settings.get('MetricsSummarySeconds', 300), self.log_metrics)
+        if self.file_heartbeat:
+            os.makedirs(os.path.dirname(self.file_heartbeat), exist_ok=True)
+            self.timers.every(self.settings.get('HeartbeatSeconds', 5), self.write_heartbeat, delay=0)
+        if self.sync_enabled and self.settings.get('SyncSeconds'):
+            self.timers.every(self.settings['SyncSeconds'], self.sync_data, delay=0)
+        tasks = [asyncio.create_task(self.poller.run()), asyncio.create_task(self.stream.run()),
+                 asyncio.create_task(self.price_cache.run()), asyncio.create_task(self.timers.run())]
+        try:
+            await asyncio.gather(*[self.run_pair(pair=pair) for pair in pairs_list])
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.stats.flush()
+            if self.recorder is not None:
+                self.recorder.close()
+            self.executor.shutdown(wait=False)
+            self.order_executor.shutdown(wait=False)
+
+    def main(self, pairs_list=None):
+        """
+        :param pairs_list: pairs to trade, defaults to the ones in Pairs.csv
+        """
         self.enable_cmd_colors()
         self.banner()
-        self.LOGGER.info(f'3CommasBot launched')
-        self.client = self.get_3commas_api(api_key=self.api_key, secret=self.api_secret)
-        pairs_list = pd.read_csv(self.file_pairs, index_col=None)
-        pairs_list = [pair['Pair'] for pair in pairs_list.iloc]
+        self.LOGGER.info(f'3CommasBot launched' + (f' as worker {self.worker}' if self.worker else ''))
+        self.client = self.get_client(client=self.get_3commas_api(api_key=self.api_key, secret=self.api_secret))
+        if self.settings.get('MetricsPort'):
+            self.metrics.serve(port=self.settings['MetricsPort'])
+            self.LOGGER.info(f'Metrics served on http://127.0.0.1:{self.settings["MetricsPort"]}/metrics')
+        if pairs_list is None:
+            with open(self.file_pairs, newline='') as f:
+                pairs_list = [pair['Pair'] for pair in csv.DictReader(f)]
         self.LOGGER.info(f'Trading pairs: {pairs_list}')
         account_balance_long = self.get_account_balance(account_id=self.settings['AccountIDLong'])
         account_balance_short = self.get_account_balance(account_id=self.settings['AccountIDShort'])
+        # Seed the exposure engine, it refreshes the balances in the background from here on
+        for account_id, balance in ((self.settings['AccountIDLong'], account_balance_long),
+                                    (self.settings['AccountIDShort'], account_balance_short)):
+            if balance is not None:
+                self.exposure.set_balance(account_id, balance)
         self.LOGGER.info(f'Account balance LONG: {account_balance_long}')
         self.LOGGER.info(f'Account balance SHORT: {account_balance_short}')
-        self.strategy(pair=pairs_list[0])
-        # with concurrent.futures.ThreadPoolExecutor(max_workers=len(pairs_list)) as executor:
-        #     results = executor.map(self.strategy, pairs_list)
-        #     try:
-        #         for x, result in results:
-        #             self.LOGGER.info(f'Results: {result}')
-        #     except Exception as e:
-        #         self.LOGGER.info(e)
+        asyncio.run(self.run_pairs(pairs_list=pairs_list))
 
 
 if __name__ == '__main__':
-    ThreeCommasBot().main()
+    parser = argparse.ArgumentParser(description='3Commas SmartTrades Bot')
+    parser.add_argument('--stats', action='store_true', help='print TP/TSL stats per pair and exit')
+    parser.add_argument('--pair', help='pair to print stats of, e.g. USDT_MANA')
+    parser.add_argument('--hours', type=float, help='stats look back window in hours, e.g. 24')
+    parser.add_argument('--sync', action='store_true', help='sync deals, SmartTrades and bot stats into Sync.db, '
+                                                            'print them per pair and exit, or as a worker, keep syncing')
+    parser.add_argument('--worker', help='run as a worker of 3CommasSupervisor with this name')
+    parser.add_argument('--pairs', nargs='*', help='pairs to trade instead of Pairs.csv')
+    parser.add_argument('--account-set', type=int, help='index of the AccountSets entry to trade with')
+    parser.add_argument('--set-workers', type=int, default=1, help='workers sharing the request budget of the account set')
+    parser.add_argument('--metrics-port', type=int, help='metrics port instead of MetricsPort')
+    parser.add_argument('--res-dir', help='directory of Settings.json, Pairs.csv and the state files')
+    parser.add_argument('--record', help='record all 3Commas requests and responses to this file, for 3CommasReplay.py')
+    args = parser.parse_args()
+    if args.stats:
+        ThreeCommasBot(res_dir=args.res_dir).report_stats(pair=args.pair, hours=args.hours)
+    elif args.sync and not args.worker:
+        bot = ThreeCommasBot(res_dir=args.res_dir)
+        bot.client = bot.get_client(client=bot.get_3commas_api(api_key=bot.api_key, secret=bot.api_secret))
+        print(f'Synced: {bot.sync()}')
+        bot.report_sync(hours=args.hours)
+    else:
+        bot = ThreeCommasBot(res_dir=args.res_dir, worker=args.worker)
+        if args.account_set is not None:
+            bot.use_account_set(account_set=args.account_set, set_workers=args.set_workers)
+        if args.metrics_port is not None:
+            bot.settings['MetricsPort'] = args.metrics_port
+        if args.sync:
+            bot.sync_enabled = True
+        bot.file_record = args.record
+        if args.worker:
+            # Stop on SIGTERM of the supervisor like on Ctrl+C, flushing the buffered stats
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        bot.main(pairs_list=args.pairs)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    *******************************************************************************************
+    3CommasReplay: Replays 3Commas traffic recorded with 3CommasBot.py --record against the bot
+    Author: Ali Toori
+    Website: https://boteaz.com/
+    *******************************************************************************************
+"""
+import argparse
+import asyncio
+import collections
+import gzip
+import importlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import zlib
+from time import monotonic, process_time, sleep
+
+bot_module = importlib.import_module('3CommasBot')
+bench_module = importlib.import_module('3CommasBenchmark')
+
+# Settings in seconds, divided by the speed of the replay
+TIME_SETTINGS = ('CheckInterval', 'MinCheckInterval', 'MaxCheckInterval', 'ReconcileInterval', 'PriceTTL',
+                 'MaxPriceStaleness', 'MarketRulesTTL', 'BalanceRefreshSeconds', 'StatsFlushSeconds',
+                 'MetricsSummarySeconds', 'TimerTickSeconds')
+
+
+# Read the sessions of a recording, one per run of the bot
+def read_sessions(file_record):
+    """
+    :return: list of sessions, each a list of records
+    """
+    sessions = []
+    with gzip.open(file_record, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if "Session" in record or not sessions:
+                    sessions.append([])
+                sessions[-1].append(record)
+        # The bot was killed before the recording was closed, keep what was flushed
+        except (EOFError, zlib.error):
+            pass
+    return sessions
+
+
+class ReplayClient:
+    """
+    Drop-in for Py3CW that answers from a recorded session, speed times faster than it was recorded. Every request gets
+    the next recorded response to the same request in the order they were recorded, reads with the same payload and
+    orders and deal updates of the same account and pair, so the answers never depend on the wall clock. A read past the
+    last recorded response gets the last one again. Requests that were never recorded are answered with an error and
+    counted in misses.
+    """
+    WRITE_ACTIONS = ('new', 'cancel', 'close_by_market', 'update_deal')
+
+    def __init__(self, records, speed=1.0, latency=True):
+        """
+        :param records: request records of a session, as read by read_sessions()
+        :param latency: wait the recorded duration of every request, divided by speed
+        """
+        self.speed = speed
+        self.latency = latency
+        self.reads = collections.defaultdict(list)
+        self.read_index = collections.Counter()
+        self.writes = collections.defaultdict(collections.deque)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.misses = collections.Counter()
+        for record in records:
+            if "E" not in record:
+                continue
+            response = (record.get("Err") or {}, record.get("R"), record.get("D", 0.0))
+            if record["A"] in self.WRITE_ACTIONS:
+                self.writes[self.get_write_key(record["E"], record["A"], record.get("I"), record.get("P"))].append(response)
+            else:
+                self.reads[self.get_read_key(record["E"], record["A"], record.get("I"), record.get("P"))].append(
+                    (record["T"] + record.get("D", 0.0), response))
+        # Threads write records as their requests complete, put them back in the order they were answered
+        for responses in self.reads.values():
+            responses.sort(key=lambda answered: answered[0])
+
+    @staticmethod
+    def get_read_key(entity, action, action_id, payload):
+        return entity, action, str(action_id), json.dumps(payload, sort_keys=True)
+
+    @staticmethod
+    def get_write_key(entity, action, action_id, payload):
+        payload = payload or {}
+        return entity, action, str(action_id), str(payload.get("account_id")), payload.get("pair")
+
+    def request(self, entity, action='', action_id=None, action_sub_id=None, payload=None, additional_headers=None):
+        with self.lock:
+            self.requests += 1
+            if action in self.WRITE_ACTIONS:
+                responses = self.writes.get(self.get_write_key(entity, action, action_id, payload))
+                response = responses.popleft() if responses else None
+            else:
+                key = self.get_read_key(entity, action, action_id, payload)
+                responses = self.reads.get(key)
+                response = responses[min(self.read_index[key], len(responses) - 1)][1] if responses else None
+                self.read_index[key] += 1
+            if response is None:
+                self.misses[f'{entity}/{action}'] += 1
+        if response is None:
+            return {"error": True, "msg": f'Not recorded: {entity} {action} {action_id or ""}'.strip(),
+                    "status_code": None}, {}
+        error, data, seconds = response
+        if self.latency:
+            sleep(seconds / self.speed)
+        return error, data
+
+
+# Settings of the recorded run, sped up and cut off from Telegram, the websocket, metrics and sync
+def get_replay_settings(settings, speed):
+    settings = dict(bench_module.BENCH_SETTINGS, **settings)
+    for key in TIME_SETTINGS:
+        if key in settings:
+            settings[key] = settings[key] / speed
+    settings['PairPriceTTL'] = {pair: ttl / speed for pair, ttl in settings.get('PairPriceTTL', {}).items()}
+    settings['RequestRate'] = settings.get('RequestRate', 5) * speed
+    settings.update(StreamURL='', BotToken='', ChatID='', MetricsPort=0, SyncSeconds=0)
+    return settings
+
+
+# Replay a recorded session against the bot
+def replay(file_record, session=-1, speed=10.0, pairs=None, latency=True):
+    """
+    :param session: index of the session in the recording, the last one by default
+    :param pairs: pairs to replay, all the recorded ones by default
+    :return: dict of the measurements and the final state of every pair
+    """
+    records = read_sessions(file_record)[session]
+    start = next((record["Start"] for record in records if "Start" in record), None)
+    if start is None:
+        raise ValueError(f'{file_record} has no Start record, the bot did not get to trading')
+    pairs = [pair for pair in start["Pairs"] if not pairs or pair in pairs]
+    duration = max(record["T"] + record.get("D", 0.0) for record in records)
+    client = ReplayClient(records=records, speed=speed, latency=latency)
+    with tempfile.TemporaryDirectory() as res_dir:
+        # Pick up from the states the recorded run started from
+        with open(os.path.join(res_dir, 'SmartTradesState.jsonl'), 'w') as f:
+            for state in start["States"].values():
+                f.write(json.dumps(state) + '\n')
+        bot = bot_module.ThreeCommasBot(settings=get_replay_settings(start["Settings"], speed), res_dir=res_dir)
+        bot.client = bot.get_client(client=client)
+        bot.stream.connect = None
+        logging.getLogger().setLevel(logging.WARNING)
+
+        async def run():
+            try:
+                # One more check after the recording ends, for the last responses to be acted on
+                await asyncio.wait_for(bot.run_pairs(pairs_list=pairs), timeout=duration / speed + bot.settings['CheckInterval'])
+            except asyncio.TimeoutError:
+                pass
+
+        start_time, start_cpu = monotonic(), process_time()
+        asyncio.run(run())
+        elapsed, cpu = monotonic() - start_time, process_time() - start_cpu
+    latencies = list(bot.reentry_latencies)
+    return {
+        "Pairs": len(pairs),
+        "Speed": speed,
+        "RecordedSeconds": round(duration, 3),
+        "Seconds": round(elapsed, 3),
+        "CPUSeconds": round(cpu, 3),
+        "PairTicks": sum(state.ticks for state in bot.pair_states.values()),
+        "Requests": client.requests,
+        "Misses": dict(client.misses),
+        "Reentries": len(latencies),
+        "ReentryP50Ms": round(bench_module.percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "ReentryP99Ms": round(bench_module.percentile(latencies, 99) * 1000, 2) if latencies else None,
+        "States": {pair: {key: state.to_dict()[key] for key in ('Level', 'PnL', 'TradeCount', 'TPCount', 'TSLCount')}
+                   for pair, state in sorted(bot.pair_states.items())},
+    }
+
+
+# Print the measurements and pair states that changed against an earlier replay. Pair states only depend on the
+# recording, measurements also on how fast the machine runs the bot, so the same recording polls a few times more or less
+def compare(result, file_baseline):
+    with open(file_baseline, 'r') as f:
+        baseline = json.load(f)
+    changes = []
+    for key in ('CPUSeconds', 'PairTicks', 'Requests', 'Reentries', 'ReentryP50Ms', 'ReentryP99Ms'):
+        value, base_value = result.get(key), baseline.get(key)
+        if value and base_value:
+            changes.append(f'{key}: {base_value} -> {value} ({(value - base_value) / base_value * 100:+.1f}%)')
+    print(', '.join(changes))
+    for pair, state in result["States"].items():
+        base_state = baseline["States"].get(pair)
+        if state != base_state:
+            print(f'Pair: {pair}, State: {base_state} -> {state}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay 3Commas traffic recorded with 3CommasBot.py --record')
+    parser.add_argument('record', help='recording file')
+    parser.add_argument('--session', type=int, default=-1, help='session of the recording to replay, the last by default')
+    parser.add_argument('--speed', type=float, default=10, help='times faster than recorded')
+    parser.add_argument('--pairs', nargs='+', help='pairs to replay instead of all the recorded ones')
+    parser.add_argument('--no-latency', action='store_true', help='answer at once instead of after the recorded latency')
+    parser.add_argument('--output', help='file to save the result to')
+    parser.add_argument('--compare', help='earlier result file to compare with')
+    args = parser.parse_args()
+    result = replay(file_record=args.record, session=args.session, speed=args.speed, pairs=args.pairs,
+                    latency=not args.no_latency)
+    print(json.dumps(result, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=4)
+    if args.compare:
+        compare(result, args.compare)
+
+
+if __name__ == '__main__':
+    main()
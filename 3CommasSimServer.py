@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    *******************************************************************************************
+    3CommasSimServer: Local 3Commas API stand-in for load and latency testing of 3CommasBot
+    Author: Ali Toori
+    Website: https://boteaz.com/
+    *******************************************************************************************
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import sleep, monotonic
+from urllib.parse import urlparse, parse_qsl
+
+PROJECT_ROOT = Path(os.path.abspath(os.path.dirname(__file__)))
+FILE_PAIRS = str(PROJECT_ROOT / '3CommasRes/Pairs.csv')
+FILE_SETTINGS = str(PROJECT_ROOT / '3CommasRes/Settings.json')
+
+# (HTTP method, path under /public/api/) -> (Py3CW entity, action)
+ROUTES = [
+    ('GET', r'ver1/accounts', ('accounts', '')),
+    ('GET', r'ver1/accounts/currency_rates', ('accounts', 'currency_rates')),
+    ('POST', r'ver1/accounts/(?P<id>\w+)/load_balances', ('accounts', 'load_balances')),
+    ('GET', r'ver1/deals', ('deals', '')),
+    ('GET', r'ver1/bots', ('bots', '')),
+    ('GET', r'v2/smart_trades', ('smart_trades_v2', '')),
+    ('POST', r'v2/smart_trades', ('smart_trades_v2', 'new')),
+    ('GET', r'v2/smart_trades/(?P<id>\w+)', ('smart_trades_v2', 'get_by_id')),
+    ('DELETE', r'v2/smart_trades/(?P<id>\w+)', ('smart_trades_v2', 'cancel')),
+    ('POST', r'v2/smart_trades/(?P<id>\w+)/close_by_market', ('smart_trades_v2', 'close_by_market')),
+]
+
+
+class SimExchange:
+    """
+    In-memory 3Commas: accounts with balances, a price feed per pair and SmartTrades that fill their TP steps and
+    trailing stop loss as the feed moves. Requests are answered like the 3Commas API, after the configured latency,
+    and fail with 502 or 429 at the configured rates. Every SmartTrade update is published to the subscribed listeners.
+    """
+    def __init__(self, pairs, account_ids, balance=10000.0, volatility=0.001, latency=0.0, error_rate=0.0,
+                 rate_limit=0, rate_limit_window=60.0, feed=None, seed=None):
+        """
+        :param pairs: pairs with a price feed
+        :param account_ids: accounts to simulate
+        :param balance: starting USD balance of every account
+        :param volatility: standard deviation of a synthetic price step
+        :param latency: mean seconds taken to answer a request
+        :param error_rate: share of requests answered with 502
+        :param rate_limit: requests allowed per rate_limit_window before answering 429, 0 for no limit
+        :param feed: dict of pair: list of prices to replay instead of the synthetic random walk
+        """
+        self.random = random.Random(seed)
+        self.volatility = volatility
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.feed = feed or {}
+        self.feed_index = {pair: 0 for pair in pairs}
+        self.prices = {pair: self.feed[pair][0] if pair in self.feed else self.random.uniform(0.5, 5.0) for pair in pairs}
+        self.rules = {pair: self.get_rules(price) for pair, price in self.prices.items()}
+        self.accounts = {str(account_id): {"id": account_id, "name": f'Sim {account_id}', "market_code": "binance",
+                                           "usd_amount": balance} for account_id in account_ids}
+        self.smart_trades = {}
+        self.open_ids = set()
+        self.next_id = 1
+        self.requests = 0
+        self.window_start = monotonic()
+        self.window_requests = 0
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    # Move every pair one step along its feed and fill the SmartTrades it crossed
+    def tick(self):
+        with self.lock:
+            for pair, price in self.prices.items():
+                if pair in self.feed:
+                    self.feed_index[pair] = (self.feed_index[pair] + 1) % len(self.feed[pair])
+                    self.prices[pair] = self.feed[pair][self.feed_index[pair]]
+                else:
+                    self.prices[pair] = price * math.exp(self.random.gauss(0, self.volatility))
+            for smart_trade_id in list(self.open_ids):
+                self.process(self.smart_trades[smart_trade_id])
+
+    # Exchange rules of a pair listed at price, cheaper pairs trade in bigger lots with finer price steps
+    @staticmethod
+    def get_rules(price, min_total=5.0):
+        magnitude = math.floor(math.log10(price))
+        return {"priceStep": 10.0 ** (magnitude - 4), "lotStep": 10.0 ** max(-3, -magnitude - 1),
+                "minLotSize": 10.0 ** max(-3, -magnitude - 1), "minTotal": min_total}
+
+    # True if value is a multiple of step
+    @staticmethod
+    def on_step(value, step):
+        return abs(value / step - round(value / step)) < 1e-6
+
+    def set_status(self, smart_trade, status_type, title):
+        smart_trade["status"] = {"type": status_type, "basic_type": status_type, "title": title}
+        smart_trade["updated_at"] = datetime.utcnow().isoformat()
+        self.publish(smart_trade)
+
+    # Call listener(smart_trade) on every SmartTrade update, from the thread that made the update
+    def subscribe(self, listener):
+        with self.lock:
+            self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    # caller holds the lock
+    def publish(self, smart_trade):
+        if self.listeners:
+            message = json.dumps(self.public(smart_trade))
+            for listener in self.listeners:
+                listener(message)
+
+    # Fill TP steps or the trailing stop loss of an open SmartTrade, caller holds the lock
+    def process(self, smart_trade):
+        price = self.prices[smart_trade["pair"]]
+        sim = smart_trade["sim"]
+        sign = sim["sign"]
+        smart_trade["data"]["current_price"] = {"last": str(price), "bid": str(price), "ask": str(price)}
+        sim["best"] = max(sim["best"] * sign, price * sign) * sign
+        if sim["trailing"]:
+            sim["stop"] = max(sim["stop"] * sign, sim["best"] * (1 - sign * sim["trailing"] / 100) * sign) * sign
+        smart_trade["stop_loss"]["conditional"]["price"]["value"] = str(sim["stop"])
+        if (price - sim["stop"]) * sign <= 0:
+            self.close(smart_trade, price=sim["stop"], status_type='stop_loss_finished', title='Stop Loss Finished')
+            return
+        for step in smart_trade["take_profit"]["steps"]:
+            if step["status"] == 'idle' and (price - float(step["price"]["value"])) * sign >= 0:
+                step["status"] = 'completed'
+                sim["realized"] += sim["qty"] * step["volume"] / 100 * (float(step["price"]["value"]) - sim["entry"]) * sign
+                sim["open_volume"] -= step["volume"]
+                self.set_profit(smart_trade, price)
+                self.publish(smart_trade)
+        if sim["open_volume"] <= 0:
+            self.close(smart_trade, price=price, status_type='completed', title='Completed')
+            return
+        self.set_profit(smart_trade, price)
+        if smart_trade["status"]["type"] == 'waiting_position':
+            self.set_status(smart_trade, 'waiting_targets', 'Waiting Targets')
+
+    def set_profit(self, smart_trade, price):
+        sim = smart_trade["sim"]
+        profit = sim["realized"] + sim["qty"] * sim["open_volume"] / 100 * (price - sim["entry"]) * sim["sign"]
+        smart_trade["profit"] = {"usd": str(round(profit, 8)), "percent": str(round(profit / sim["notional"] * 100, 4))}
+
+    # Close the rest of a SmartTrade at price, caller holds the lock
+    def close(self, smart_trade, price, status_type, title):
+        self.set_profit(smart_trade, price)
+        smart_trade["sim"]["realized"] = float(smart_trade["profit"]["usd"])
+        smart_trade["sim"]["open_volume"] = 0
+        self.accounts[str(smart_trade["account"]["id"])]["usd_amount"] += smart_trade["sim"]["realized"]
+        self.set_status(smart_trade, status_type, title)
+        self.open_ids.discard(smart_trade["id"])
+
+    # Create a SmartTrade from a smart_trades_v2/new payload, caller holds the lock
+    def new_smart_trade(self, payload):
+        pair = payload.get("pair")
+        if pair not in self.prices:
+            return 422, {"error": "record_invalid", "error_description": f'Unknown pair {pair}'}
+        if str(payload.get("account_id")) not in self.accounts:
+            return 422, {"error": "record_invalid", "error_description": 'Unknown account'}
+        price = self.prices[pair]
+        rules = self.rules[pair]
+        sign = 1 if payload["position"]["type"] == 'buy' else -1
+        qty = float(payload["position"]["units"]["value"])
+        if not self.on_step(qty, rules["lotStep"]) or qty < rules["minLotSize"] or qty * price < rules["minTotal"]:
+            return 422, {"error": "record_invalid", "error_description": f'Invalid quantity {qty} of {pair}'}
+        for step in (payload.get("take_profit") or {}).get("steps") or []:
+            if not self.on_step(float(step["price"]["value"]), rules["priceStep"]):
+                return 422, {"error": "record_invalid", "error_description": f'Invalid price {step["price"]["value"]} of {pair}'}
+        stop_loss = payload.get("stop_loss") or {}
+        conditional = stop_loss.get("conditional") or {}
+        trailing = conditional.get("trailing") or {}
+        stop = float((conditional.get("price") or {}).get("value") or price * (1 - sign * 0.99))
+        steps = [{"id": i, "status": 'idle', "volume": float(step.get("volume", 100)),
+                  "price": {"value": str(step["price"]["value"]), "type": step["price"].get("type", 'bid')}}
+                 for i, step in enumerate((payload.get("take_profit") or {}).get("steps") or [], start=1)]
+        now = datetime.utcnow().isoformat()
+        smart_trade = {
+            "id": self.next_id, "account": {"id": payload["account_id"]}, "pair": pair, "note": payload.get("note", ''),
+            "position": {"type": payload["position"]["type"], "units": {"value": str(qty)}, "price": {"value": str(price)}},
+            "leverage": payload.get("leverage", {}),
+            "take_profit": {"enabled": bool(steps), "steps": steps},
+            "stop_loss": {"enabled": bool(stop_loss), "conditional": {
+                "price": {"value": str(stop)}, "trailing": {"enabled": str(trailing.get("enabled")).lower() == 'true',
+                                                            "percent": trailing.get("percent")}}},
+            "profit": {"usd": "0.0", "percent": "0.0"}, "data": {"current_price": {"last": str(price)}},
+            "created_at": now, "updated_at": now,
+            "sim": {"sign": sign, "qty": qty, "entry": price, "notional": max(qty * price, 1e-12), "best": price,
+                    "stop": stop, "open_volume": sum(step["volume"] for step in steps) or 100.0, "realized": 0.0,
+                    "trailing": abs(float(trailing.get("percent") or 0))
+                    if str(trailing.get("enabled")).lower() == 'true' else 0.0}}
+        self.set_status(smart_trade, 'waiting_position', 'Waiting Position')
+        self.smart_trades[smart_trade["id"]] = smart_trade
+        self.open_ids.add(smart_trade["id"])
+        self.next_id += 1
+        return 200, self.public(smart_trade)
+
+    @staticmethod
+    def public(smart_trade):
+        return {key: value for key, value in smart_trade.items() if key != 'sim'}
+
+    # Answer a request like the 3Commas API would
+    def request(self, entity, action='', action_id=None, payload=None):
+        """
+        :return: HTTP status and JSON body
+        """
+        if self.latency:
+            sleep(self.random.expovariate(1 / self.latency))
+        with self.lock:
+            self.requests += 1
+            if self.rate_limit:
+                if monotonic() - self.window_start >= self.rate_limit_window:
+                    self.window_start, self.window_requests = monotonic(), 0
+                self.window_requests += 1
+                if self.window_requests > self.rate_limit:
+                    return 429, {"error": "rate_limit_exceeded", "error_description": 'Too many requests'}
+            if self.error_rate and self.random.random() < self.error_rate:
+                return 502, {"error": "bad_gateway", "error_description": 'Simulated upstream failure'}
+            return self.dispatch(entity, action, action_id, payload or {})
+
+    # caller holds the lock
+    def dispatch(self, entity, action, action_id, payload):
+        if (entity, action) == ('accounts', ''):
+            return 200, list(self.accounts.values())
+        if (entity, action) == ('accounts', 'load_balances'):
+            account = self.accounts.get(str(action_id))
+            return (200, dict(account)) if account else (404, {"error": "not_found", "error_description": 'Account'})
+        if (entity, action) == ('accounts', 'currency_rates'):
+            price = self.prices.get(payload.get("pair"))
+            if price is None:
+                return 422, {"error": "unknown_pair", "error_description": f'Unknown pair {payload.get("pair")}'}
+            return 200, dict({"last": str(price), "bid": str(price), "ask": str(price)},
+                             **{key: str(value) for key, value in self.rules[payload["pair"]].items()})
+        # The stand-in runs no DCA bots
+        if (entity, action) in (('deals', ''), ('bots', '')):
+            return 200, []
+        if (entity, action) == ('smart_trades_v2', 'new'):
+            return self.new_smart_trade(payload)
+        if (entity, action) == ('smart_trades_v2', ''):
+            smart_trades = [smart_trade for smart_trade in self.smart_trades.values()
+                            if str(smart_trade["account"]["id"]) == str(payload.get("account_id", smart_trade["account"]["id"]))
+                            and (payload.get("status", 'all') != 'active' or smart_trade["id"] in self.open_ids)]
+            if payload.get("order_by") in ('created_at', 'updated_at'):
+                smart_trades.sort(key=lambda smart_trade: smart_trade[payload["order_by"]],
+                                  reverse=payload.get("order_direction") == 'desc')
+            page, per_page = int(payload.get("page", 1)), int(payload.get("per_page", 10))
+            return 200, [self.public(smart_trade) for smart_trade in smart_trades[(page - 1) * per_page:page * per_page]]
+        smart_trade = self.smart_trades.get(int(action_id)) if str(action_id).isdigit() else None
+        if entity == 'smart_trades_v2' and smart_trade is None:
+            return 404, {"error": "not_found", "error_description": f'SmartTrade {action_id}'}
+        if (entity, action) == ('smart_trades_v2', 'get_by_id'):
+            return 200, self.public(smart_trade)
+        if (entity, action) in (('smart_trades_v2', 'cancel'), ('smart_trades_v2', 'close_by_market')):
+            if smart_trade["id"] in self.open_ids:
+                if action == 'cancel':
+                    self.close(smart_trade, price=smart_trade["sim"]["entry"], status_type='cancelled', title='Cancelled')
+                else:
+                    self.close(smart_trade, price=self.prices[smart_trade["pair"]], status_type='panic_sold', title='Closed By Market')
+            return 200, self.public(smart_trade)
+        return 404, {"error": "not_found", "error_description": f'{entity}/{action}'}
+
+    # Keep ticking the price feed in a background thread until stop()
+    def start(self, tick_interval=1.0):
+        def run():
+            while not self.stopped.wait(tick_interval):
+                self.tick()
+        thread = threading.Thread(target=run, name='SimExchangeFeed', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped.set()
+
+
+class SimClient:
+    """
+    Drop-in for Py3CW that talks to a SimExchange in-process, returning (error, data) the way Py3CW.request does
+    """
+    def __init__(self, exchange):
+        self.exchange = exchange
+
+    def request(self, entity, action='', action_id=None, action_sub_id=None, payload=None, additional_headers=None):
+        status, data = self.exchange.request(entity=entity, action=action, action_id=action_id, payload=payload)
+        if status != 200:
+            return {"error": True, "msg": f'Other error occurred: {data["error"]} {data["error_description"]}.',
+                    "status_code": status}, {}
+        return {}, data
+
+
+class SimStream:
+    """
+    In-process stand-in for the 3Commas websocket. connect() returns a connection that speaks the ActionCable frames of
+    wss://ws.3commas.io/websocket: welcome, pings, subscription confirmations and SmartTradesChannel messages.
+    """
+    CHANNELS = ('SmartTradesChannel',)
+
+    def __init__(self, exchange, ping_interval=3.0):
+        self.exchange = exchange
+        self.ping_interval = ping_interval
+        self.connections = set()
+        self.connects = 0
+
+    # Drop-in for websockets.connect, must be called from the event loop of the bot
+    def connect(self, url):
+        self.connects += 1
+        return SimStreamConnection(self)
+
+    # Close every open connection, like the 3Commas websocket going down
+    def drop(self):
+        for connection in list(self.connections):
+            connection.close()
+
+
+class SimStreamConnection:
+    def __init__(self, stream):
+        self.stream = stream
+        self.loop = asyncio.get_running_loop()
+        self.frames = asyncio.Queue()
+        self.identifier = None
+        self.closed = False
+        stream.connections.add(self)
+        self.put({"type": "welcome"})
+
+    # Queue a frame, callable from any thread
+    def put(self, message):
+        try:
+            self.loop.call_soon_threadsafe(self.frames.put_nowait, json.dumps(message))
+        except RuntimeError:
+            pass
+
+    def publish(self, smart_trade):
+        if not self.closed:
+            self.put({"identifier": self.identifier, "message": json.loads(smart_trade)})
+
+    async def send(self, frame):
+        message = json.loads(frame)
+        if message.get("command") != 'subscribe':
+            return
+        identifier = json.loads(message["identifier"])
+        if identifier.get("channel") not in self.stream.CHANNELS or not identifier.get("users"):
+            self.put({"identifier": message["identifier"], "type": "reject_subscription"})
+            return
+        self.identifier = message["identifier"]
+        self.stream.exchange.subscribe(self.publish)
+        self.put({"identifier": self.identifier, "type": "confirm_subscription"})
+
+    async def recv(self):
+        if self.closed:
+            raise ConnectionError('Connection closed')
+        try:
+            frame = await asyncio.wait_for(self.frames.get(), timeout=self.stream.ping_interval)
+        except asyncio.TimeoutError:
+            return json.dumps({"type": "ping", "message": int(datetime.utcnow().timestamp())})
+        if frame is None:
+            raise ConnectionError('Connection closed')
+        return frame
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.stream.connections.discard(self)
+        self.stream.exchange.unsubscribe(self.publish)
+        self.loop.call_soon_threadsafe(self.frames.put_nowait, None)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class SimRequestHandler(BaseHTTPRequestHandler):
+    exchange = None
+    routes = [(method, re.compile(f'/public/api/{path}$'), target) for method, path, target in ROUTES]
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        for route_method, route, (entity, action) in self.routes:
+            match = route.match(url.path)
+            if route_method == method and match:
+                break
+        else:
+            return self.send_json(404, {"error": "not_found", "error_description": url.path})
+        payload = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            payload.update(json.loads(self.rfile.read(length)) or {})
+        status, data = self.exchange.request(entity=entity, action=action, action_id=match.groupdict().get('id'),
+                                             payload=payload)
+        self.send_json(status, data)
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve a SimExchange over HTTP at the same paths as api.3commas.io
+def serve(exchange, host='127.0.0.1', port=8080):
+    """
+    Point the bot at it with "APIURL": "http://127.0.0.1:8080" in Settings.json
+    """
+    handler = type('Handler', (SimRequestHandler,), {"exchange": exchange})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local 3Commas API stand-in for 3CommasBot')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--pairs', type=int, help='simulate this many synthetic pairs instead of Pairs.csv')
+    parser.add_argument('--replay-dir', help='replay closes of <dir>/<pair>.csv instead of a random walk')
+    parser.add_argument('--tick', type=float, default=1.0, help='seconds between price steps')
+    parser.add_argument('--volatility', type=float, default=0.001, help='standard deviation of a price step')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds to answer a request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 502')
+    parser.add_argument('--rate-limit', type=int, default=0, help='requests per minute before answering 429')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    with open(FILE_SETTINGS, 'r') as f:
+        settings = json.load(f)["Settings"]
+    if args.pairs:
+        pairs = [f'USDT_SIM{i}' for i in range(args.pairs)]
+    else:
+        with open(FILE_PAIRS, 'r') as f:
+            pairs = [line.strip() for line in f.readlines()[1:] if line.strip()]
+    feed = None
+    if args.replay_dir:
+        import importlib
+        load_candles = importlib.import_module('3CommasBacktest').load_candles
+        feed = {pair: load_candles(os.path.join(args.replay_dir, f'{pair}.csv'))[:, 2].tolist() for pair in pairs}
+    exchange = SimExchange(pairs=pairs, account_ids=[settings['AccountIDLong'], settings['AccountIDShort']],
+                           volatility=args.volatility, latency=args.latency, error_rate=args.error_rate,
+                           rate_limit=args.rate_limit, feed=feed, seed=args.seed)
+    exchange.start(tick_interval=args.tick)
+    server = serve(exchange, host=args.host, port=args.port)
+    print(f'3Commas stand-in serving {len(pairs)} pairs on http://{args.host}:{args.port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    *******************************************************************************************
+    3CommasSupervisor: Runs 3CommasBot as worker processes sharded by pair and account set
+    Author: Ali Toori
+    Website: https://boteaz.com/
+    *******************************************************************************************
+"""
+import argparse
+import csv
+import importlib
+import json
+import os
+import signal
+import subprocess
+import sys
+from pathlib import Path
+from time import sleep, monotonic, time
+
+PROJECT_ROOT = Path(os.path.abspath(os.path.dirname(__file__)))
+FILE_BOT = str(PROJECT_ROOT / '3CommasBot.py')
+bot_module = importlib.import_module('3CommasBot')
+
+
+class Worker:
+    """
+    One 3CommasBot process trading a shard of the pairs with one account set
+    """
+    def __init__(self, name, account_set, set_workers, metrics_port=None, sync=False):
+        self.name = name
+        self.sync = sync
+        self.account_set = account_set
+        self.set_workers = set_workers
+        self.metrics_port = metrics_port
+        self.pairs = []
+        self.process = None
+        self.started_at = None
+        self.restarts = 0
+        self.restart_at = 0
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+
+class Supervisor:
+    """
+    Splits the pairs of Pairs.csv across WorkersPerAccountSet worker processes per entry of AccountSets, each with its
+    own Py3CW client and share of the request budget of its API key. Workers are restarted from their persisted state
+    when they exit or stop writing heartbeats, and pairs are rebalanced when Pairs.csv changes. A pair with open
+    SmartTrades stays on the account set they were placed with.
+    """
+    def __init__(self, res_dir=None, workers_per_set=None):
+        """
+        :param res_dir: directory of the pairs, state and stats files, defaults to 3CommasRes
+        :param workers_per_set: workers per account set instead of WorkersPerAccountSet
+        """
+        self.bot = bot_module.ThreeCommasBot(res_dir=res_dir)
+        self.LOGGER = self.bot.LOGGER
+        self.res_dir = res_dir
+        self.settings = self.bot.settings
+        self.account_sets = [dict(self.settings, **account_set) for account_set in self.settings.get('AccountSets') or [{}]]
+        self.workers_per_set = workers_per_set or self.settings.get('WorkersPerAccountSet', 2)
+        self.health_timeout = self.settings.get('WorkerHealthTimeout', 60)
+        self.check_seconds = self.settings.get('WorkerCheckSeconds', 5)
+        self.rebalance_seconds = self.settings.get('RebalanceSeconds', 60)
+        self.max_backoff = self.settings.get('WorkerMaxBackoff', 60)
+        metrics_port = self.settings.get('MetricsPort')
+        self.workers = []
+        for account_set in range(len(self.account_sets)):
+            for i in range(self.workers_per_set):
+                self.workers.append(Worker(name=f'w{account_set}-{i}', account_set=account_set,
+                                           set_workers=self.workers_per_set, sync=i == 0,
+                                           metrics_port=metrics_port + 1 + len(self.workers) if metrics_port else None))
+        self.stopping = False
+
+    def load_pairs(self):
+        with open(self.bot.file_pairs, newline='') as f:
+            return [pair['Pair'] for pair in csv.DictReader(f)]
+
+    # Account set of every pair with open SmartTrades, from the latest state in the journals of all the workers
+    def get_pair_account_sets(self):
+        states = bot_module.StateJournal.read_states(files=self.bot.get_worker_files('SmartTradesState*.jsonl'))
+        account_ids = {str(account_set['AccountIDLong']): i for i, account_set in enumerate(self.account_sets)}
+        return {pair: account_ids[str(state['AccountIDLong'])] for pair, state in states.items()
+                if state.get('SmartTradeLong') and str(state.get('AccountIDLong')) in account_ids}
+
+    # Shard the pairs across the workers, keeping pairs where they are unless a worker has more than its share
+    def assign(self, pairs):
+        """
+        :return: dict of worker name: sorted pairs
+        """
+        pair_account_sets = self.get_pair_account_sets()
+        set_pairs = {account_set: [] for account_set in range(len(self.account_sets))}
+        free_pairs = []
+        for pair in pairs:
+            if pair in pair_account_sets:
+                set_pairs[pair_account_sets[pair]].append(pair)
+            else:
+                free_pairs.append(pair)
+        for pair in free_pairs:
+            min(set_pairs.values(), key=len).append(pair)
+        current = {pair: worker.name for worker in self.workers for pair in worker.pairs}
+        assignment = {}
+        for account_set, pairs_of_set in set_pairs.items():
+            workers = [worker.name for worker in self.workers if worker.account_set == account_set]
+            shards = {name: [] for name in workers}
+            moving = []
+            for pair in pairs_of_set:
+                (shards[current[pair]] if current.get(pair) in shards else moving).append(pair)
+            # Take the pairs above the share of every worker, then hand them to the workers below it
+            share, extra = divmod(len(pairs_of_set), len(workers))
+            for i, name in enumerate(sorted(workers, key=lambda name: -len(shards[name]))):
+                limit = share + (1 if i < extra else 0)
+                moving.extend(shards[name][limit:])
+                del shards[name][limit:]
+            for pair in moving:
+                shards[min(workers, key=lambda name: len(shards[name]))].append(pair)
+            assignment.update({name: sorted(shard) for name, shard in shards.items()})
+        return assignment
+
+    def start(self, worker):
+        command = [sys.executable, FILE_BOT, '--worker', worker.name, '--account-set', str(worker.account_set),
+                   '--set-workers', str(worker.set_workers), '--pairs', *worker.pairs]
+        if self.res_dir:
+            command += ['--res-dir', str(self.res_dir)]
+        if worker.metrics_port:
+            command += ['--metrics-port', str(worker.metrics_port)]
+        # One worker per account set keeps Sync.db up to date
+        if worker.sync:
+            command += ['--sync']
+        worker.process = subprocess.Popen(command, cwd=str(PROJECT_ROOT))
+        worker.started_at = time()
+        self.LOGGER.info(f'Worker {worker.name} started, PID: {worker.process.pid}, pairs: {worker.pairs}')
+
+    # Stop a worker with SIGTERM so it flushes its stats, killing it if it does not exit in time
+    def stop(self, worker, timeout=10):
+        if not worker.is_running():
+            return
+        worker.process.terminate()
+        try:
+            worker.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.LOGGER.info(f'Worker {worker.name} did not stop in {timeout} seconds, killing it')
+            worker.process.kill()
+            worker.process.wait()
+        self.LOGGER.info(f'Worker {worker.name} stopped')
+
+    # Why a worker is unhealthy, None if it is healthy
+    def check(self, worker):
+        if worker.process is None:
+            return None
+        exit_code = worker.process.poll()
+        if exit_code is not None:
+            return f'exited with code {exit_code}'
+        if time() - worker.started_at < self.health_timeout:
+            return None
+        try:
+            with open(os.path.join(self.bot.RES_DIR, 'Workers', f'{worker.name}.json'), 'r') as f:
+                heartbeat = json.load(f)
+        except (OSError, ValueError):
+            return f'wrote no heartbeat in {self.health_timeout} seconds'
+        if heartbeat.get("PID") != worker.process.pid or time() - heartbeat["TimeStamp"] > self.health_timeout:
+            return f'wrote no heartbeat in {self.health_timeout} seconds'
+        return None
+
+    # Apply a new assignment, restarting only the workers whose pairs changed
+    def rebalance(self, pairs):
+        assignment = self.assign(pairs)
+        changed = [worker for worker in self.workers if assignment[worker.name] != worker.pairs]
+        if not changed:
+            return
+        self.LOGGER.info(f'Rebalancing {len(pairs)} pairs across {len(self.workers)} workers')
+        # Stop every changed worker before starting any, so that a moved pair is never traded twice
+        for worker in changed:
+            self.stop(worker)
+        for worker in changed:
+            worker.pairs = assignment[worker.name]
+            worker.process = None
+            if worker.pairs:
+                self.start(worker)
+
+    def get_status(self):
+        return {worker.name: {"PID": worker.process.pid if worker.is_running() else None, "Pairs": len(worker.pairs),
+                              "Restarts": worker.restarts} for worker in self.workers}
+
+    def run(self):
+        def shutdown(signum, frame):
+            self.stopping = True
+        signal.signal(signal.SIGTERM, shutdown)
+        pairs = self.load_pairs()
+        self.LOGGER.info(f'3CommasSupervisor launched with {len(self.workers)} workers on {len(self.account_sets)} account sets')
+        self.rebalance(pairs)
+        rebalance_at = monotonic() + self.rebalance_seconds
+        try:
+            while not self.stopping:
+                sleep(self.check_seconds)
+                for worker in self.workers:
+                    if not worker.pairs:
+                        continue
+                    if worker.process is None:
+                        if monotonic() >= worker.restart_at:
+                            self.start(worker)
+                        continue
+                    reason = self.check(worker)
+                    if reason is None:
+                        # Forget old crashes once a worker has been healthy for a while
+                        if worker.restarts and time() - worker.started_at > 5 * self.health_timeout:
+                            worker.restarts = 0
+                        continue
+                    backoff = min(self.max_backoff, 2 ** worker.restarts)
+                    self.LOGGER.info(f'Worker {worker.name} {reason}, restarting in {backoff} seconds')
+                    self.bot.send_telegram_msg(msg=f'Worker {worker.name} {reason}, restarting')
+                    self.stop(worker)
+                    worker.process = None
+                    worker.restarts += 1
+                    worker.restart_at = monotonic() + backoff
+                if monotonic() >= rebalance_at:
+                    rebalance_at = monotonic() + self.rebalance_seconds
+                    pairs = self.load_pairs()
+                    self.rebalance(pairs)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.LOGGER.info(f'3CommasSupervisor stopping, status: {self.get_status()}')
+            for worker in self.workers:
+                self.stop(worker)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run 3CommasBot as worker processes sharded by pair and account set')
+    parser.add_argument('--workers', type=int, help='workers per account set, defaults to WorkersPerAccountSet')
+    parser.add_argument('--res-dir', help='directory of Settings.json, Pairs.csv and the state files')
+    args = parser.parse_args()
+    Supervisor(res_dir=args.res_dir, workers_per_set=args.workers).run()
+
+
+if __name__ == '__main__':
+    main()